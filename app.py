@@ -1,19 +1,32 @@
-from settings import database, shared_secret, log_file
-from flask import Flask, render_template, request, redirect, url_for, session, abort
+from settings import (
+    database, shared_secret, log_file, scheduler_lease_ttl, metrics_token, last_login_flush_seconds, refresh_cooldown
+)
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, abort, make_response, Response, stream_with_context,
+    jsonify, g
+)
+from werkzeug.http import is_resource_modified
 from models import (
-    Institution, get_all_institutions, submit_inst_add_form, submit_inst_edit_form, get_institution_scalar,
-    get_institution, User, user_login, get_last_update, get_all_last_updates
+    acquire_lease, release_lease, get_leases, Institution, get_all_institutions, submit_inst_add_form,
+    submit_inst_edit_form, get_institution_scalar, get_institution, User, user_login, get_last_update,
+    get_all_institutions_updated, group_by_request, get_latest_refresh_stats, flush_last_logins, get_schedules,
+    holds_lease, add_refresh_job, get_pending_refresh_job, get_latest_refresh_job, get_refresh_job,
+    get_refresh_job_position, get_dashboard_institutions, get_dashboard_statuses, get_dashboard_aging,
+    get_dashboard_partners, aging_label, search_requests, get_search_version
 )
-from utils import db
+from utils import db, response_cache, metrics, prometheus_sample, csv_chunks, xlsx_file, file_chunks
 from functools import wraps
+from datetime import datetime, timedelta, timezone
+import hashlib
+import time
 import schedulers
+import socket
 import os
 import jwt
 from flask_apscheduler import APScheduler
 import atexit
 import logging
 from logging.handlers import TimedRotatingFileHandler
-import flask_excel as excel
 
 # create app
 app = Flask(__name__)
@@ -32,24 +45,58 @@ app.secret_key = app.config['SESSION_KEY']  # set the session key
 app.config['LOG_FILE'] = log_file  # set the audit log file
 
 db.init_app(app)  # initialize SQLAlchemy
-excel.init_excel(app)  # initialize Flask-Excel
 
 # database
 with app.app_context():  # need to be in app context to create the database
     db.create_all()  # create the database
 
 # scheduler
+#   every process runs the scheduler, but only the one holding the 'update_reports' lease refreshes the reports
 scheduler = APScheduler()  # create the scheduler
 scheduler.init_app(app)  # initialize the scheduler
 scheduler.start()  # start the scheduler
-atexit.register(lambda: scheduler.shutdown())  # Shut down the scheduler when exiting the app
+scheduler_id = f'{socket.gethostname()}:{os.getpid()}'  # this process, as a lease holder
+
+
+# Give up the lease (if this process holds it), write any buffered last logins and shut down the scheduler when
+#   exiting the app
+@atexit.register
+def shutdown_scheduler():
+    scheduler.shutdown()
+    with app.app_context():
+        release_lease('update_reports', scheduler_id)
+        flush_last_logins()
+
+
+# Background task to take or keep the lease, so another process takes over if the leader dies
+@scheduler.task('interval', id='scheduler_lease', seconds=max(scheduler_lease_ttl // 3, 1))
+def scheduler_lease():
+    with scheduler.app.app_context():  # need to be in app context to access the database
+        acquire_lease('update_reports', scheduler_id, scheduler_lease_ttl)
+
 
+# Background task to write the last login times buffered by this process
+@scheduler.task('interval', id='flush_logins', seconds=last_login_flush_seconds)
+def flush_logins():
+    with scheduler.app.app_context():  # need to be in app context to access the database
+        flush_last_logins()
+
+
+# Background task to refresh the institutions that are due; their refreshes are spread across the hour and adapted
+#   to how often their data changes (see schedulers.refresh_due)
+@scheduler.task('interval', id='refresh_due', minutes=1)
+def refresh_due():
+    with scheduler.app.app_context():  # need to be in app context to access the database
+        if acquire_lease('update_reports', scheduler_id, scheduler_lease_ttl):  # only the leader refreshes
+            schedulers.refresh_due()  # refresh the institutions that are due
 
-# Background task to update the reports
-@scheduler.task('cron', id='update_reports', minute=55)  # run at 55 minutes past the hour
-def update_reports():
+
+# Background task to run the on-demand refreshes queued from the report pages
+@scheduler.task('interval', id='refresh_jobs', seconds=5)
+def refresh_jobs():
     with scheduler.app.app_context():  # need to be in app context to access the database
-        schedulers.update_reports()  # update the reports
+        if holds_lease('update_reports', scheduler_id):  # only the leader runs them; checking doesn't renew the lease
+            schedulers.run_refresh_jobs()  # run the queued refreshes
 
 
 # set up error handlers & templates for HTTP codes used in abort()
@@ -81,6 +128,22 @@ file_handler.setFormatter(logging.Formatter('%(asctime)s\t%(message)s'))  # set
 audit_log.addHandler(file_handler)  # add the file handler to the audit log
 
 
+# Start timing a request
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+# Time the request's handler once its response has been sent, so streamed downloads are timed to the last byte
+@app.after_request
+def stop_timer(response):
+    if request.endpoint is not None and 'request_start' in g:
+        start, labels = g.request_start, (('endpoint', request.endpoint),)
+        response.call_on_close(
+            lambda: metrics.observe('http_request_duration_seconds', labels, time.perf_counter() - start))
+    return response
+
+
 # decorator for pages that need auth
 def auth_required(f):
     @wraps(f)  # preserve the original function's metadata
@@ -93,6 +156,40 @@ def auth_required(f):
     return decorated
 
 
+# The parts of the session that the rendered pages show (see base.html), for keying cached pages
+def session_key():
+    return session['username'], session['display_name'], session['user_home'], tuple(session['authorizations'])
+
+
+# Serve a response from the response cache, with a strong ETag and Last-Modified derived from its key
+#   browsers that already have it get a 304 without render() being called; otherwise render() is only called
+#   if the response isn't cached yet, or every time if store is False (for streamed responses)
+def cached_response(key, last_modified, render, store=True):
+    etag = hashlib.sha256(repr(key).encode()).hexdigest()  # the key identifies the content
+    if last_modified is not None:
+        last_modified = last_modified.astimezone(timezone.utc)  # updates are stored in local time
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    elif not store:
+        response = make_response(render())
+    else:
+        entry = response_cache.get(key)
+        if entry is None:
+            rendered = make_response(render())
+            entry = (rendered.get_data(), rendered.status_code, dict(rendered.headers))
+            if rendered.status_code == 200:
+                response_cache.set(key, entry)
+        response = Response(*entry)
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True  # pages are per user
+    response.cache_control.no_cache = True  # but may be revalidated
+    response.vary.add('Cookie')
+    return response
+
+
 # Home page
 @app.route('/')
 @auth_required
@@ -102,10 +199,69 @@ def index():
         # If not, redirect to the reports page for their institution
         return redirect(url_for('report', code=session['user_home']))
 
-    insts = get_all_institutions()  # get all institutions
-    updates = get_all_last_updates()  # get all last updates
+    insts = get_all_institutions_updated()  # get all institutions with their last updates
+    last_modified = max((updated for _, updated in insts if updated is not None), default=None)  # the most recent
+
+    # The page only changes when an institution or an update does
+    key = ('index', None, tuple((inst.code, inst.name, updated) for inst, updated in insts), session_key())
+    return cached_response(key, last_modified, lambda: render_template('reports.html', institutions=insts))
+
+
+# Partners listed on the dashboard, busiest first
+dashboard_partners = 20
+
+
+# Consortium dashboard: request counts by status, age and partner across every institution's published report
+#   read from the rollups built with each report, so it's a few small queries however many requests there are
+@app.route('/dashboard')
+@auth_required
+def dashboard():
+    if 'admin' not in session['authorizations']:
+        abort(403)  # if the user is not an admin, abort with a 403 error
 
-    return render_template('reports.html', institutions=insts, updates=updates)
+    insts = get_dashboard_institutions()  # each institution's totals and last update
+    last_modified = max((inst.last_update for inst in insts if inst.last_update is not None), default=None)
+
+    # Render the rest of the dashboard, unless it's already cached
+    def render():
+        statuses = get_dashboard_statuses()  # requests per status
+        aging = [(aging_label(bucket.bucket), bucket.requests) for bucket in get_dashboard_aging()]  # per age
+        partners = get_dashboard_partners(dashboard_partners)  # the busiest partners
+        return render_template('dashboard.html', institutions=insts, statuses=statuses, aging=aging, partners=partners)
+
+    # The page only changes when an institution or an update does
+    key = ('dashboard', None, tuple(tuple(inst) for inst in insts), session_key())
+    return cached_response(key, last_modified, render)
+
+
+# Search the requests of the user's institution (or, for admins, of every institution or the one given by ?code=)
+#   ?q=<network number, internal ID, start of the requestor, or words of the title or author>&after=<id>&limit=<rows>
+#   &version=<get_search_version the previous page was found in>; if the reports have been refreshed since, the
+#   search starts again from the first page
+@app.route('/search')
+@auth_required
+def search():
+    query = request.args.get('q', '').strip()  # what to search for
+    after = request.args.get('after', 0, type=int)  # the last request ID already shown
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)  # rows per page
+    code = request.args.get('code') or None  # the institution to search, if not all of them
+    if 'admin' not in session['authorizations']:
+        if code is not None and code != session['user_home']:
+            abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
+        code = session['user_home']  # users only search their home institution
+
+    rows, next_after, version, restarted = [], None, None, False
+    if query:
+        codes = None if code is None else [code]
+        version = get_search_version(codes)
+        if after and request.args.get('version') != version:
+            after, restarted = 0, True  # ids from before a refresh don't carry over
+        rows, next_after = search_requests(query, codes, after, limit)
+    response = make_response(render_template(
+        'search.html', query=query, code=code, rows=rows, after=after, next_after=next_after, limit=limit,
+        version=version, restarted=restarted))
+    response.cache_control.no_store = True  # results change with every refresh
+    return response
 
 
 # Login page
@@ -142,6 +298,15 @@ def logout():
     return redirect(url_for('index'))  # redirect to the home page
 
 
+# Token identifying one publish of an institution's report, for report pages to send back with their requests
+#   incremental refreshes publish into the same generation (renumbering its positions), so the time of the update
+#   is part of it
+def report_version(last_update):
+    if last_update is None:
+        return '0'  # never refreshed
+    return f'{last_update.generation}-{last_update.last_update.isoformat()}'
+
+
 # Report page
 @app.route('/<code>')
 @auth_required
@@ -149,33 +314,152 @@ def report(code):
     if session['user_home'] != code and 'admin' not in session['authorizations']:
         abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
 
-    inst = get_institution_scalar(code)  # get the institution
-    statuses = Institution.get_statuses(inst)  # get the statuses
-    last_update = get_last_update(code)  # get the last update
-    requests = []  # initialize the requests list
-    for status in statuses:  # for each status
-        reqs = Institution.get_requests(inst, status[0])  # get the requests for that status
-        requests.append(reqs)  # add the requests to the list
+    last_update = get_last_update(code)  # get the last update, which points at the generation to show
+    updated = last_update.last_update if last_update is not None else None  # when the data last changed
 
-    return render_template('report.html', requests=requests, inst=inst, statuses=statuses, update=last_update)
+    # Render the report's status headings from the published generation, unless it's already cached
+    #   the rows of each status are fetched from report_requests when its section is opened
+    def render():
+        inst = get_institution_scalar(code)  # get the institution
+        generation = last_update.generation if last_update is not None else 0  # the published generation
+        statuses = Institution.get_report_statuses(inst, generation)  # get the statuses and their counts
+        return render_template('report.html', statuses=statuses, inst=inst, update=last_update,
+                               version=report_version(last_update))
 
+    return cached_response(('report', code, updated, session_key()), updated, render)
 
-# Report download
+
+# Report rows for one status as JSON, grouped by request, a page at a time
+#   ?status=<status>&after=<position>&limit=<rows>&version=<report_version the page was loaded with>
+@app.route('/<code>/requests')
+@auth_required
+def report_requests(code):
+    if session['user_home'] != code and 'admin' not in session['authorizations']:
+        abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
+
+    status = request.args.get('status')  # the status to page through
+    after = request.args.get('after', 0, type=int)  # the last position already shown
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)  # rows per page
+    if status is None:
+        abort(400)  # if no status was given, abort with a 400 error
+
+    last_update = get_last_update(code)  # get the last update, which points at the generation to show
+    updated = last_update.last_update if last_update is not None else None  # when the data last changed
+    generation = last_update.generation if last_update is not None else 0  # the published generation
+    version = report_version(last_update)
+    if request.args.get('version', version) != version:
+        # the page was loaded from a report that has since been replaced, so its positions no longer line up
+        return jsonify(error='The report has been updated; reload the page to see the new data.'), 409
+
+    # Build the page from the published generation, unless it's already cached
+    def render():
+        inst = get_institution_scalar(code)  # get the institution
+        rows, after_position = Institution.get_report_page(inst, generation, status, after, limit)  # get the rows
+        return jsonify(version=version, requests=group_by_request(rows), next=after_position)
+
+    return cached_response(('requests', code, updated, status, after, limit), updated, render)
+
+
+# A refresh job as JSON, with its place in the queue and how long it has been running (or ran)
+def refresh_job_json(job):
+    duration = None
+    if job.started is not None:
+        duration = round(((job.finished or datetime.now()) - job.started).total_seconds(), 1)
+    return {
+        'id': job.id,
+        'status': job.status,  # queued, running, done or failed
+        'position': get_refresh_job_position(job),  # 1 is next; None unless queued
+        'progress': job.progress,  # the step a running refresh has reached
+        'requested': job.requested.isoformat(timespec='seconds'),
+        'started': job.started.isoformat(timespec='seconds') if job.started is not None else None,
+        'finished': job.finished.isoformat(timespec='seconds') if job.finished is not None else None,
+        'duration': duration,  # seconds
+        'url': url_for('refresh_status', code=job.instcode, job_id=job.id),
+    }
+
+
+# Queue an on-demand refresh of an institution's reports, run in the background by the scheduler leader
+#   a refresh already queued or running is returned instead of queueing another, and otherwise an institution can only
+#   be refreshed once every refresh_cooldown seconds
+@app.route('/<code>/refresh', methods=['POST'])
+@auth_required
+def refresh(code):
+    if session['user_home'] != code and 'admin' not in session['authorizations']:
+        abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
+    if request.headers.get('X-Requested-With') != 'fetch':
+        abort(400)  # only the report page's script sends this; a form posted from another site can't
+    get_institution(code)  # 404 if there's no such institution
+
+    if get_pending_refresh_job(code) is None:
+        latest = get_latest_refresh_job(code)  # the last refresh asked for
+        wait = 0
+        if latest is not None:
+            wait = int((latest.requested + timedelta(seconds=refresh_cooldown) - datetime.now()).total_seconds()) + 1
+        if wait > 0:
+            response = jsonify(error=f'This institution was refreshed recently. Try again in {wait} seconds.')
+            response.headers['Retry-After'] = str(wait)
+            return response, 429
+
+    job, added = add_refresh_job(code, session['username'])
+    if added:
+        audit_log.info(f'{session["username"]}\trefresh\t{code}')
+    return jsonify(refresh_job_json(job)), 202 if added else 200
+
+
+# Status of an on-demand refresh as JSON
+@app.route('/<code>/refresh/<int:job_id>')
+@auth_required
+def refresh_status(code, job_id):
+    if session['user_home'] != code and 'admin' not in session['authorizations']:
+        abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
+
+    job = get_refresh_job(job_id)
+    if job is None or job.instcode != code:
+        abort(404)
+    response = jsonify(refresh_job_json(job))
+    response.cache_control.no_store = True
+    return response
+
+
+# Columns of the downloaded report, in Institution.get_all_requests order
+download_columns = [
+    'Borrowing Request Status', 'Internal ID', 'Borrowing Request Date', 'Title', 'Author', 'Network Number',
+    'Requestor', 'Partner Active Status', 'Request Sending Date', 'Days Since Request', 'Partner Name', 'Partner Code',
+    'In Transit Start'
+]
+
+
+# Report download, as XLSX or (with ?format=csv) CSV
 @app.route('/<code>/download')
 @auth_required
 def report_download(code):
     if session['user_home'] != code and 'admin' not in session['authorizations']:
         abort(403)  # if the user is not an admin and not at their home institution, abort with a 403 error
 
-    inst = get_institution_scalar(code)  # get the institution
-    reqs = Institution.get_all_requests(inst)  # get all requests for the institution
+    last_update = get_last_update(code)  # get the last update, which points at the generation to download
+    updated = last_update.last_update if last_update is not None else None  # when the data last changed
 
-    # Set up the columns for the Excel file
-    columns = ['Borrowing Request Status', 'Internal ID', 'Borrowing Request Date', 'Title', 'Author', 'Network Number',
-               'Requestor', 'Partner Active Status', 'Request Sending Date', 'Days Since Request', 'Partner Name',
-               'Partner Code', 'In Transit Start']
+    export = request.args.get('format', 'xlsx')  # the file format
+    if export not in ('xlsx', 'csv'):
+        abort(400)  # if the format isn't one we offer, abort with a 400 error
 
-    return excel.make_response_from_query_sets(reqs, columns, 'xlsx', file_name=code)  # return the Excel file
+    # Stream the file from the published generation
+    def render():
+        inst = get_institution_scalar(code)  # get the institution
+        generation = last_update.generation if last_update is not None else 0  # the published generation
+        reqs = Institution.get_all_requests(inst, generation)  # stream all requests for the institution
+
+        if export == 'csv':
+            response = Response(stream_with_context(csv_chunks(download_columns, reqs)), mimetype='text/csv')
+        else:
+            xlsx = xlsx_file(download_columns, reqs, code)  # built on disk a row at a time
+            response = Response(file_chunks(xlsx), mimetype=(
+                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+        response.headers['Content-Disposition'] = f'attachment; filename={code}.{export}'
+        return response
+
+    # The file is the same for everyone allowed to download it; it's streamed rather than cached
+    return cached_response(('download', code, updated, export), updated, render, store=False)
 
 
 # Admin page
@@ -184,7 +468,49 @@ def report_download(code):
 def admin():
     if 'admin' not in session['authorizations']:
         abort(403)  # if the user is not an admin, abort with a 403 error
-    return render_template('admin.html')  # otherwise, render the admin page
+
+    leases = get_leases()  # get the scheduler leases
+    refresh_stats = get_latest_refresh_stats()  # get each institution's latest refresh statistics
+    schedules = get_schedules()  # get each institution's refresh schedule
+    return render_template('admin.html', leases=leases, now=datetime.now(), scheduler_id=scheduler_id,
+                           refresh_stats=refresh_stats, timings=metrics.summary(), schedules=schedules)
+
+
+# Refresh statistics exported by /metrics, as gauges of each institution's latest refresh: (name, attribute, help)
+refresh_gauges = (
+    ('refresh_started_timestamp_seconds', 'started', 'When the latest refresh started'),
+    ('refresh_pages', 'pages', 'Report pages fetched from Alma'),
+    ('refresh_bytes', 'bytes', 'Report bytes fetched from Alma'),
+    ('refresh_rows', 'rows', 'Report rows loaded'),
+    ('refresh_fetch_seconds', 'fetch_seconds', 'Seconds spent waiting on Alma'),
+    ('refresh_parse_seconds', 'parse_seconds', 'Seconds spent parsing and decoding the report'),
+    ('refresh_write_seconds', 'write_seconds', 'Seconds spent writing to the database'),
+    ('refresh_failed', 'failed', 'Whether the refresh failed before this report was loaded'),
+    ('refresh_unchanged', 'unchanged', 'Whether the report was the same as last time, so not parsed or loaded'),
+)
+
+
+# Metrics in the Prometheus text format, for a scraper sending metrics_token or a logged-in admin
+#   the refresh statistics come from the database, so any process can serve them; the timings are this process's own
+@app.route('/metrics')
+def prometheus_metrics():
+    scraper = bool(metrics_token) and request.headers.get('Authorization') == f'Bearer {metrics_token}'
+    if not scraper and 'admin' not in session.get('authorizations', ()):
+        abort(403)  # if neither the configured token nor an admin login came with the request, abort with a 403 error
+
+    refresh_stats = get_latest_refresh_stats()  # get each institution's latest refresh statistics
+    lines = []
+    for name, attribute, description in refresh_gauges:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} gauge')
+        for stat in refresh_stats:
+            value = getattr(stat, attribute)
+            if attribute == 'started':
+                value = value.timestamp()
+            labels = (('institution', stat.instcode), ('report', stat.report))
+            lines.append(prometheus_sample(name, labels, float(value)))
+    lines.extend(metrics.exposition())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 
 # Institutions admin page
@@ -0,0 +1,53 @@
+from benchmarks.common import make_app, timed
+from benchmarks.synthetic import request_tuples
+from models import Request, request_columns
+from utils import db, bulk_delete, bulk_insert
+import argparse
+
+
+# Delete an institution's rows from a table one ORM object at a time, committing each (the original refresh's delete)
+def delete_rows(obtype, instcode):
+    objs = obtype.query.filter_by(instcode=instcode).all()
+    for obj in objs:
+        db.session.delete(obj)
+        db.session.commit()
+
+
+# Add and commit one ORM object (the original refresh's insert)
+def database_add(dbrow):
+    db.session.add(dbrow)
+    db.session.commit()
+
+
+# Legacy path: delete ORM objects one at a time, then add and commit one ORM object per row
+def legacy_load(rows):
+    delete_rows(Request, 'bench')
+    for row in rows:
+        database_add(Request(*row, 'bench'))
+
+
+# Bulk path: one set-based delete, executemany inserts, one commit
+def bulk_load(rows):
+    bulk_delete(Request, 'bench')
+    bulk_insert(Request, request_columns, rows, instcode='bench')
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare per-row and bulk loading of the requests table')
+    parser.add_argument('--database', default='sqlite:///bench.db', help='SQLAlchemy database URI')
+    parser.add_argument('--rows', type=int, default=10000, help='number of request rows to load')
+    args = parser.parse_args()
+
+    app = make_app(args.database)
+    rows = list(request_tuples(args.rows))
+
+    with app.app_context():
+        for name, loader in (('legacy', legacy_load), ('bulk', bulk_load)):
+            loader(rows)  # warm up and leave a full table behind so the delete is measured too
+            seconds, _ = timed(loader, rows)
+            print(f'{name}: {len(rows)} rows in {seconds:.2f}s ({len(rows) / seconds:,.0f} rows/sec)')
+
+
+if __name__ == '__main__':
+    main()
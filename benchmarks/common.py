@@ -0,0 +1,24 @@
+from flask import Flask
+from utils import db
+import models
+import time
+
+
+# Create a bare Flask app bound to the benchmark database
+def make_app(database):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database  # set the database URI
+    db.init_app(app)  # initialize SQLAlchemy
+    with app.app_context():
+        db.drop_all()  # start from empty tables
+        db.create_all()  # create the database
+        db.session.add(models.Institution('bench', 'Benchmark Institution', 'key', 'exceptions', 'items', 'events'))
+        db.session.commit()
+    return app
+
+
+# Time a callable, returning (seconds, result)
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
@@ -0,0 +1,38 @@
+from benchmarks.synthetic import exceptions_rows
+from utils import exceptions_map, decoders, row_decoder
+import argparse
+import time
+
+
+# Dict decoder: rows as ColumnN -> text dicts, with a dict lookup and a type lookup per mapped column of every row
+def dict_decode(rows):
+    for exrow in rows:
+        yield tuple([decoders[kind](exrow.get(column)) for column, kind in exceptions_map.values()])
+
+
+# Typed decoder: rows as position-ordered lists, column positions resolved once, values converted to their types
+def typed_decode(rows, layout):
+    decode = row_decoder(exceptions_map, layout)
+    for values in rows:
+        yield decode(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare dict-based and precompiled typed row decoding')
+    parser.add_argument('--rows', type=int, default=50000, help='rows in the synthetic exceptions report')
+    args = parser.parse_args()
+
+    rows = list(exceptions_rows(args.rows))
+    layout = {f'Column{position}': position for position in range(len(rows[0]))}
+    dicts = [{f'Column{position}': value for position, value in enumerate(row) if value != ''} for row in rows]
+    lists = [[value or None for value in row] + [None] for row in rows]  # as parse_rows yields them
+
+    for name, decoder, source in (('dict', dict_decode, (dicts,)), ('typed', typed_decode, (lists, layout))):
+        start = time.perf_counter()
+        count = sum(1 for _ in decoder(*source))
+        seconds = time.perf_counter() - start
+        print(f'{name}: {count} rows in {seconds:.2f}s ({count / seconds:,.0f} rows/sec)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+from benchmarks.fake_alma import FakeAlma, synthetic_reports
+from benchmarks.common import timed
+from datetime import datetime
+from urllib.parse import quote
+import statistics
+import subprocess
+import argparse
+import platform
+import json
+import sys
+import os
+
+
+# Time a view through the test client, returning (seconds, bytes); the response is read to the end and closed so
+#   streamed downloads are timed in full
+def time_view(client, url):
+    def get():
+        response = client.get(url)
+        size = len(response.get_data())
+        response.close()
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} returned {response.status_code}')
+        return size
+
+    return timed(get)
+
+
+# Time a view repeatedly, cold (with the institution's cached pages dropped first) and warm
+def view_timings(client, url, code, repeat, response_cache):
+    cold, warm = [], []
+    size = 0
+    for _ in range(repeat):
+        response_cache.invalidate(code)
+        seconds, size = time_view(client, url)
+        cold.append(seconds)
+        seconds, _ = time_view(client, url)
+        warm.append(seconds)
+    return {'url': url, 'bytes': size, 'cold': summarize(cold), 'warm': summarize(warm)}
+
+
+# Mean, median and maximum of a list of timings, in milliseconds
+def summarize(seconds):
+    return {
+        'mean_ms': round(statistics.mean(seconds) * 1000, 3), 'median_ms': round(statistics.median(seconds) * 1000, 3),
+        'max_ms': round(max(seconds) * 1000, 3), 'runs': len(seconds)
+    }
+
+
+# The commit being benchmarked, if this is a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time a full refresh against a fake Alma server, then the pages')
+    parser.add_argument('--database', default='sqlite:///bench.db', help='SQLAlchemy database URI (tables are dropped)')
+    parser.add_argument('--institutions', type=int, default=4, help='number of institutions')
+    parser.add_argument('--rows', type=int, default=10000, help='exceptions report rows per institution')
+    parser.add_argument('--limit', type=int, default=1000, help='rows per report page')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake server takes per page')
+    parser.add_argument('--refreshes', type=int, default=2, help='times to run update_reports')
+    parser.add_argument('--repeat', type=int, default=10, help='times to request each page')
+    parser.add_argument('--mode', choices=('snapshot', 'incremental'), help='refresh_mode (default: settings.py)')
+    parser.add_argument('--cache-dir', help='report_cache_dir to cache the raw report pages in (default: settings.py)')
+    parser.add_argument('--replay', action='store_true', help='refresh from the pages already in the cache directory')
+    parser.add_argument('--output', help='write the results to this JSON file instead of stdout')
+    args = parser.parse_args()
+
+    # Point the app at the benchmark database before it's imported
+    import settings
+    settings.database = args.database
+    if args.mode:
+        settings.refresh_mode = args.mode
+    if args.cache_dir:
+        settings.report_cache_dir = args.cache_dir
+    settings.replay = args.replay
+
+    from app import app, scheduler, report_version
+    from models import Institution, get_institution_scalar, get_last_update, get_latest_refresh_stats
+    from utils import db, response_cache
+    import schedulers
+    import utils
+
+    scheduler.pause()  # no scheduled refreshes during the benchmark
+
+    server = FakeAlma(synthetic_reports(args.rows), limit=args.limit, latency=args.latency).start()
+    utils.api_route = server.url  # send the API calls to the fake server
+    results = {
+        'commit': git_commit(), 'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'parameters': vars(args), 'refresh': [], 'views': {}
+    }
+
+    try:
+        with app.app_context():
+            results['database'] = db.engine.dialect.name
+            db.drop_all()  # start from empty tables
+            db.create_all()
+            codes = [f'bench{number}' for number in range(args.institutions)]
+            db.session.add_all(Institution(code, f'Benchmark Institution {code}', f'key-{code}', 'exceptions',
+                                           'items', 'events') for code in codes)
+            db.session.commit()
+
+            for _ in range(args.refreshes):
+                seconds, _ = timed(schedulers.update_reports)
+                stats = {}
+                for stat in get_latest_refresh_stats():
+                    totals = stats.setdefault(stat.report, {'failed': 0})
+                    for field in ('pages', 'bytes', 'rows', 'fetch_seconds', 'parse_seconds', 'write_seconds'):
+                        totals[field] = round(totals.get(field, 0) + getattr(stat, field), 3)
+                    totals['failed'] += int(stat.failed)
+                results['refresh'].append({'seconds': round(seconds, 3), 'reports': stats})
+
+            code = codes[0]
+            last_update = get_last_update(code)
+            generation, version = last_update.generation, report_version(last_update)
+            status = Institution.get_report_statuses(get_institution_scalar(code), generation)[0].borreqstat
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'bench'
+            session['display_name'] = 'Benchmark'
+            session['user_home'] = code
+            session['authorizations'] = ['exceptions', 'admin']
+
+        views = {
+            'index': '/',
+            'dashboard': '/dashboard',
+            'report': f'/{code}',
+            'report_requests': f'/{code}/requests?status={quote(status)}&version={quote(version)}',
+            'report_download': f'/{code}/download',
+            'report_download_csv': f'/{code}/download?format=csv',
+            'search_internalid': '/search?q=INT7',
+            'search_requestor': f'/search?q={quote("Requestor 7")}',
+            'search_title': f'/search?q={quote("subtitle")}',
+        }
+        for name, url in views.items():
+            results['views'][name] = view_timings(client, url, code, args.repeat, response_cache)
+    finally:
+        server.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
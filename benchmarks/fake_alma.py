@@ -0,0 +1,101 @@
+from benchmarks.synthetic import (
+    exceptions_headings, items_headings, events_headings, exceptions_rows, items_rows, events_rows, report_pages
+)
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import threading
+import time
+import itertools
+
+
+# Local stand-in for the Alma Analytics reports API, serving synthetic reports a page at a time
+#   reports maps a report path to (headings, rows); like Alma, the first call for a path returns the first page and a
+#   ResumptionToken, and each call with the token returns the next page
+#   pages of limit rows are rendered up front, so rendering doesn't count against the refresh being timed; latency
+#   is added to every response to stand in for Alma's
+class FakeAlma(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, reports, limit=1000, latency=0.0, port=0):
+        super().__init__(('127.0.0.1', port), FakeAlmaHandler)
+        self.latency = latency
+        self.reports = {path: (headings, list(rows)) for path, (headings, rows) in reports.items()}
+        self.rendered = {}  # (path, limit) -> rendered pages, shared by every caller
+        self.cursors = {}  # (token, apikey) -> [pages, next page]
+        self.tokens = itertools.count(1)
+        self.lock = threading.Lock()
+        self.thread = None
+        for path in self.reports:
+            self.page({'path': [path], 'limit': [str(limit)]})  # renders the report (and starts an unused cursor)
+        self.cursors.clear()
+
+    # The base URL to use as utils.api_route
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    # Serve in a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-alma', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # The next page of a report, starting it if there's no token; None if the report or token is unknown
+    def page(self, params):
+        apikey = params.get('apikey', [''])[0]
+        with self.lock:
+            if 'token' in params:
+                key = (params['token'][0], apikey)
+                if key not in self.cursors:
+                    return None
+            else:
+                path, limit = params.get('path', [''])[0], int(params.get('limit', ['1000'])[0])
+                if path not in self.reports:
+                    return None
+                if (path, limit) not in self.rendered:  # render each report once
+                    headings, rows = self.reports[path]
+                    token = f'FAKE{next(self.tokens)}'
+                    self.rendered[path, limit] = (token, list(report_pages(headings, rows, limit, token)))
+                token, pages = self.rendered[path, limit]
+                key = (token, apikey)
+                self.cursors[key] = [pages, 0]
+            pages, number = self.cursors[key]
+            if number + 1 < len(pages):
+                self.cursors[key][1] += 1
+            else:
+                del self.cursors[key]  # that was the last page
+        return pages[number]
+
+
+class FakeAlmaHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        time.sleep(self.server.latency)
+        body = self.server.page(parse_qs(url.query)) if url.path.endswith('/analytics/reports') else None
+        if body is None:
+            self.send_error(400, 'Unknown report or token')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the benchmark output clean
+
+
+# The three synthetic reports for an institution with the given number of exceptions report rows
+#   (two partner rows per request, an item per request and an in-transit event for every other item)
+def synthetic_reports(rows, exceptions='exceptions', items='items', events='events'):
+    requests = (rows + 1) // 2
+    return {
+        exceptions: (exceptions_headings, exceptions_rows(rows)),
+        items: (items_headings, items_rows(requests)),
+        events: (events_headings, events_rows(requests // 2)),
+    }
@@ -0,0 +1,58 @@
+from benchmarks.synthetic import exceptions_headings, exceptions_rows, report_page
+from utils import parse_rows, exceptions_map
+from bs4 import BeautifulSoup
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+
+# Previous parser: build a BeautifulSoup tree and search each row once per mapped column
+def soup_parse(response):
+    soup = BeautifulSoup(response, features='xml')
+    for exrow in soup.find_all('Row'):
+        values = []
+        for column, _ in exceptions_map.values():
+            element = exrow.find(column)
+            values.append(element.get_text() if element is not None else None)
+        yield values
+
+
+# Streaming parser: iterparse rows into position-ordered lists and pick the mapped columns out of them
+def stream_parse(response):
+    layout = {}  # column name -> list position, read from the schema
+    for exrow in parse_rows(response, layout):
+        yield [exrow[layout.get(column, -1)] for column, _ in exceptions_map.values()]
+
+
+parsers = {'soup': soup_parse, 'stream': stream_parse}
+
+
+# Parse one synthetic report with one parser and print rows, seconds and peak RSS
+def run(mode, rows):
+    response = report_page(exceptions_headings, exceptions_rows(rows))
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    count = sum(1 for _ in parsers[mode](response))
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    print(f'{mode}: {count} rows in {seconds:.2f}s ({count / seconds:,.0f} rows/sec), peak RSS +{peak / 1024:.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the BeautifulSoup and streaming report parsers')
+    parser.add_argument('--rows', type=int, default=20000, help='rows in the synthetic exceptions report')
+    parser.add_argument('--mode', choices=sorted(parsers), help='run a single parser in this process')
+    args = parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.rows)
+    else:
+        for mode in ('soup', 'stream'):  # separate processes so peak RSS isn't shared
+            subprocess.run([sys.executable, '-m', 'benchmarks.parse', '--rows', str(args.rows), '--mode', mode],
+                           check=True)
+
+
+if __name__ == '__main__':
+    main()
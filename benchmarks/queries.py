@@ -0,0 +1,86 @@
+from benchmarks.common import make_app, timed
+from benchmarks.synthetic import request_tuples, item_tuples, event_tuples
+from models import (
+    Institution, Request, Item, Event, User, Inst_update, Latest_update, request_columns, item_columns, event_columns,
+    get_institution_scalar, get_last_update, get_all_institutions_updated, check_user, report_item_join,
+    report_event_join, group_by_request, build_report
+)
+from utils import db, bulk_insert
+from datetime import datetime, timedelta
+import argparse
+import sqlalchemy as sa
+
+
+# Fill the database with several institutions' data, a refresh history and some users
+def populate(institutions, rows, updates):
+    for number in range(institutions):
+        code = f'inst{number}' if number > 0 else 'bench'  # make_app has already added the first one
+        if number > 0:
+            db.session.add(Institution(code, f'Institution {number}', 'key', 'exceptions', 'items', 'events'))
+            db.session.flush()
+        bulk_insert(Request, request_columns, request_tuples(rows), instcode=code, generation=1)
+        bulk_insert(Item, item_columns, item_tuples(rows // 2), instcode=code, generation=1)
+        bulk_insert(Event, event_columns, event_tuples(rows // 4), instcode=code, generation=1)
+        build_report(code, 1)
+        history = [datetime(2023, 1, 1) + timedelta(hours=hour) for hour in range(updates)]
+        db.session.add_all(Inst_update(code, updated, 1) for updated in history)
+        db.session.add(Latest_update(code, history[-1], 1))
+    db.session.add_all(User(f'user{number}', None, 'bench', False, None) for number in range(5000))
+    db.session.commit()
+
+
+# Print the query plan of a statement
+def explain(statement):
+    compiled = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    for row in db.session.execute(sa.text(prefix + str(compiled))):
+        print('    ', tuple(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the report queries with and without their indexes')
+    parser.add_argument('--database', default='sqlite:///bench.db', help='SQLAlchemy database URI')
+    parser.add_argument('--institutions', type=int, default=20, help='number of institutions')
+    parser.add_argument('--rows', type=int, default=5000, help='request rows per institution')
+    parser.add_argument('--updates', type=int, default=2000, help='refresh history rows per institution')
+    parser.add_argument('--repeat', type=int, default=20, help='times to run each query')
+    parser.add_argument('--plans', action='store_true', help='print query plans')
+    args = parser.parse_args()
+
+    app = make_app(args.database)
+    with app.app_context():
+        populate(args.institutions, args.rows, args.updates)
+        inst = get_institution_scalar('bench')
+        status = Institution.get_statuses(inst, 1)[0][0]
+
+        queries = {
+            'get_statuses': lambda: Institution.get_statuses(inst, 1),
+            'get_requests': lambda: Institution.get_requests(inst, 1, status),
+            'get_report_statuses': lambda: Institution.get_report_statuses(inst, 1),
+            'get_report_page': lambda: group_by_request(Institution.get_report_page(inst, 1, status, 0, 100)[0]),
+            'get_all_requests': lambda: Institution.get_all_requests(inst, 1),
+            'get_last_update': lambda: get_last_update(inst.code),
+            'get_all_institutions_updated': lambda: get_all_institutions_updated(),
+            'check_user': lambda: check_user('user4999'),
+        }
+
+        indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+        for label in ('indexed', 'unindexed'):
+            print(label)
+            for name, query in queries.items():
+                seconds = sum(timed(query)[0] for _ in range(args.repeat)) / args.repeat
+                print(f'  {name}: {seconds * 1000:.2f} ms')
+            if args.plans:
+                print('  get_requests plan:')
+                explain(db.select(Request.id, Event.eventstart).join(Item, report_item_join, isouter=True).join(
+                    Event, report_event_join, isouter=True).filter(
+                    Request.instcode == inst.code, Request.generation == 1, Request.borreqstat == status))
+            if label == 'indexed':
+                for index in indexes:
+                    index.drop(db.session.connection())  # then repeat without them
+                db.session.commit()
+                db.engine.dispose()  # new connections, so no statements prepared against the indexes are reused
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from xml.sax.saxutils import escape
+from datetime import date, datetime, timedelta
+
+# Namespaces used by Alma Analytics report responses
+rowset_ns = 'urn:schemas-microsoft-com:xml-analysis:rowset'
+schema_ns = 'http://www.w3.org/2001/XMLSchema'
+saw_ns = 'urn:saw-sql'
+
+# Column headings of the synthetic reports, by ColumnN position
+exceptions_headings = [
+    '0', 'Author', 'Network Number', 'Title', 'Borrowing Creation Date', 'Borrowing Request Status',
+    'Fulfillment Request ID', 'Internal ID', 'Lender', 'Partner Active Status', 'Request Sending Date',
+    'Partner Code', 'Partner Name', 'Requestor', 'User Primary Identifier', 'Days in Status'
+]
+items_headings = ['0', 'Item ID', 'Fulfillment Request ID']
+events_headings = ['0', 'Event Start Date and Time', 'Item ID']
+
+
+# Synthetic exceptions report rows: two partner rows per request, as in the real report
+def exceptions_rows(count, seed=0):
+    start = date(2023, 1, 1)
+    for i in range(count):
+        req = i // 2 + seed
+        yield [
+            '0', f'Author {req % 1000}', f'(OCoLC){req}', f'Title {req} & subtitle',
+            (start + timedelta(days=req % 300)).isoformat(), f'Status {req % 8}', f'FR{req}', f'INT{req}', '',
+            'Active', (datetime(2023, 1, 1) + timedelta(hours=i)).isoformat(timespec='seconds'), f'P{i % 40}',
+            f'Partner {i % 40}', f'Requestor {req % 500}', f'U{req % 500}', str(i % 90)
+        ]
+
+
+# Synthetic items report rows: one item per request
+def items_rows(count, seed=0):
+    for i in range(count):
+        yield ['0', f'IT{i + seed}', f'FR{i + seed}']
+
+
+# Synthetic events report rows: an in-transit event for every other item
+def events_rows(count, seed=0):
+    for i in range(count):
+        yield ['0', (datetime(2023, 6, 1) + timedelta(minutes=i)).isoformat(timespec='seconds'), f'IT{2 * i + seed}']
+
+
+# Synthetic request, item and event row tuples in request_columns/item_columns/event_columns order, already typed,
+#   for loading straight into the database
+def request_tuples(count):
+    for i in range(count):
+        req = i // 2
+        yield (
+            f'FR{req}', f'U{req % 500}', f'Status {req % 8}', f'INT{req}',
+            date(2023, 1, 1) + timedelta(days=req % 300), f'Title {req}', f'Author {req % 1000}', f'(OCoLC){req}',
+            'Active', datetime(2023, 1, 1) + timedelta(hours=i), i % 90, f'Requestor {req % 500}', f'Partner {i % 40}',
+            f'P{i % 40}'
+        )
+
+
+def item_tuples(count):
+    for i in range(count):
+        yield f'IT{i}', f'FR{i}'
+
+
+def event_tuples(count):
+    for i in range(count):
+        yield f'IT{2 * i}', datetime(2023, 6, 1) + timedelta(minutes=i)
+
+
+# Render one page of an Analytics report response
+#   token is only included on the first page, as Alma does; finished marks the last page
+def report_page(headings, rows, token=None, finished=True):
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?><report><QueryResult>']
+    if token is not None:
+        parts.append(f'<ResumptionToken>{token}</ResumptionToken>')
+    parts.append(f'<IsFinished>{"true" if finished else "false"}</IsFinished><ResultXml>')
+    parts.append(f'<rowset xmlns="{rowset_ns}"><xsd:schema xmlns:xsd="{schema_ns}" xmlns:saw-sql="{saw_ns}">')
+    parts.append('<xsd:complexType name="Row"><xsd:sequence>')
+    for position, heading in enumerate(headings):
+        parts.append(f'<xsd:element minOccurs="0" maxOccurs="1" name="Column{position}" type="xsd:string" '
+                     f'saw-sql:columnHeading="{escape(heading)}"/>')
+    parts.append('</xsd:sequence></xsd:complexType></xsd:schema>')
+    for row in rows:
+        parts.append('<Row>')
+        for position, value in enumerate(row):
+            if value != '':  # Alma leaves out empty columns
+                parts.append(f'<Column{position}>{escape(value)}</Column{position}>')
+        parts.append('</Row>')
+    parts.append('</rowset></ResultXml></QueryResult></report>')
+    return ''.join(parts).encode()
+
+
+# Split report rows into pages shaped like Alma's ResumptionToken paging
+def report_pages(headings, rows, limit=1000, token='SYNTHETIC'):
+    rows = list(rows)
+    pages = [rows[i:i + limit] for i in range(0, len(rows), limit)] or [[]]
+    for number, page in enumerate(pages):
+        first, last = number == 0, number == len(pages) - 1
+        yield report_page(headings, page, token=token if first and not last else None, finished=last)
@@ -0,0 +1,8 @@
+-- Generation-based snapshots of each institution's report data (MySQL)
+--   existing rows become generation 0, which is what institutions without a refresh since the upgrade show
+--   apply with: mysql <database> < migrations/001_generations.sql
+
+ALTER TABLE request ADD COLUMN generation BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE item ADD COLUMN generation BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE event ADD COLUMN generation BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE inst_update ADD COLUMN generation BIGINT NOT NULL DEFAULT 0;
@@ -0,0 +1,7 @@
+-- Content hashes for incremental refreshes (MySQL)
+--   existing rows have no hash, so the first incremental refresh of each institution rewrites them
+--   apply with: mysql <database> < migrations/002_rowhash.sql
+
+ALTER TABLE request ADD COLUMN rowhash VARCHAR(32) NULL;
+ALTER TABLE item ADD COLUMN rowhash VARCHAR(32) NULL;
+ALTER TABLE event ADD COLUMN rowhash VARCHAR(32) NULL;
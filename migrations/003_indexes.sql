@@ -0,0 +1,9 @@
+-- Indexes for the report, download, index page and login queries (MySQL 8, which honours DESC index parts)
+--   apply with: mysql <database> < migrations/003_indexes.sql
+--   InnoDB builds these online; the old single-column foreign key indexes on instcode are left in place
+
+CREATE INDEX ix_request_report ON request (instcode, generation, borreqstat, internalid DESC, borcreate DESC);
+CREATE INDEX ix_item_request ON item (instcode, generation, fulfillmentreqid);
+CREATE INDEX ix_event_item ON event (instcode, generation, itemid);
+CREATE INDEX ix_inst_update_latest ON inst_update (instcode, last_update);
+CREATE INDEX ix_user_username ON user (username);
@@ -0,0 +1,50 @@
+-- Materialized report tables, and the index for paging through one status of the report (MySQL)
+--   apply with: mysql <database> < migrations/004_report_row_status.sql
+--   safe to apply whether or not the app has already created the tables
+
+CREATE TABLE IF NOT EXISTS report_row (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    generation BIGINT NOT NULL,
+    position BIGINT NOT NULL,
+    borreqstat VARCHAR(255),
+    internalid VARCHAR(255),
+    borcreate DATE,
+    title VARCHAR(510),
+    author VARCHAR(255),
+    networknum VARCHAR(255),
+    partnerstat VARCHAR(255),
+    reqsend DATETIME,
+    days INTEGER,
+    requestor VARCHAR(255),
+    partnername VARCHAR(255),
+    partnercode VARCHAR(255),
+    eventstart DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_report_row_position (instcode, generation, position),
+    INDEX ix_report_row_status (instcode, generation, borreqstat, position)
+);
+
+CREATE TABLE IF NOT EXISTS report_status (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    generation BIGINT NOT NULL,
+    borreqstat VARCHAR(255),
+    requests INTEGER NOT NULL,
+    `rows` INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_report_status (instcode, generation, borreqstat)
+);
+
+-- A report_row created by an earlier version of the app lacks the status index; MySQL has no CREATE INDEX IF NOT
+--   EXISTS, so look for it first
+SET @missing = (SELECT COUNT(*) = 0 FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = 'report_row' AND index_name = 'ix_report_row_status');
+SET @statement = IF(@missing,
+                    'CREATE INDEX ix_report_row_status ON report_row (instcode, generation, borreqstat, position)',
+                    'DO 0');
+PREPARE migration FROM @statement;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
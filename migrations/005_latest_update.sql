@@ -0,0 +1,18 @@
+-- Latest update per institution, filled from the existing refresh history (MySQL)
+--   apply with: mysql <database> < migrations/005_latest_update.sql
+--   run it before starting the upgraded app, or the report pages show no data until each institution's next refresh
+
+CREATE TABLE IF NOT EXISTS latest_update (
+    instcode VARCHAR(255) NOT NULL,
+    last_update DATETIME NOT NULL,
+    generation BIGINT NOT NULL,
+    PRIMARY KEY (instcode),
+    FOREIGN KEY (instcode) REFERENCES institution (code)
+);
+
+INSERT INTO latest_update (instcode, last_update, generation)
+SELECT history.instcode, history.last_update, history.generation
+FROM inst_update history
+JOIN (SELECT instcode, MAX(last_update) AS last_update FROM inst_update GROUP BY instcode) latest
+    ON latest.instcode = history.instcode AND latest.last_update = history.last_update
+ON DUPLICATE KEY UPDATE generation = GREATEST(latest_update.generation, VALUES(generation));
@@ -0,0 +1,19 @@
+-- Refresh statistics per institution and report (MySQL)
+--   apply with: mysql <database> < migrations/006_refresh_stat.sql
+
+CREATE TABLE IF NOT EXISTS refresh_stat (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    report VARCHAR(32) NOT NULL,
+    started DATETIME NOT NULL,
+    pages INTEGER NOT NULL,
+    bytes BIGINT NOT NULL,
+    `rows` INTEGER NOT NULL,
+    fetch_seconds FLOAT NOT NULL,
+    parse_seconds FLOAT NOT NULL,
+    write_seconds FLOAT NOT NULL,
+    failed BOOL NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_refresh_stat_latest (instcode, started)
+);
@@ -0,0 +1,10 @@
+-- Record which reports were skipped because they hadn't changed (MySQL)
+--   apply with: mysql <database> < migrations/007_refresh_stat_unchanged.sql
+--   safe to apply whether or not the app has already created refresh_stat with the column
+
+SET @missing = (SELECT COUNT(*) = 0 FROM information_schema.columns
+                WHERE table_schema = DATABASE() AND table_name = 'refresh_stat' AND column_name = 'unchanged');
+SET @statement = IF(@missing, 'ALTER TABLE refresh_stat ADD COLUMN unchanged BOOL NOT NULL DEFAULT 0', 'DO 0');
+PREPARE migration FROM @statement;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
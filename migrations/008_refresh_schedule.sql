@@ -0,0 +1,13 @@
+-- Per-institution refresh schedules (MySQL)
+--   apply with: mysql <database> < migrations/008_refresh_schedule.sql
+--   institutions are given schedules, spread across the hour, the first time the scheduler runs
+
+CREATE TABLE IF NOT EXISTS refresh_schedule (
+    instcode VARCHAR(255) NOT NULL,
+    `interval` INTEGER NOT NULL,
+    next_refresh DATETIME NOT NULL,
+    target INTEGER NOT NULL,
+    PRIMARY KEY (instcode),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_refresh_schedule_next_refresh (next_refresh)
+);
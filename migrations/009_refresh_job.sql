@@ -0,0 +1,17 @@
+-- On-demand refresh job queue (MySQL)
+--   apply with: mysql <database> < migrations/009_refresh_job.sql
+
+CREATE TABLE IF NOT EXISTS refresh_job (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    requested_by VARCHAR(255),
+    requested DATETIME NOT NULL,
+    started DATETIME,
+    finished DATETIME,
+    status VARCHAR(16) NOT NULL,
+    progress VARCHAR(64),
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_refresh_job_status (status, id),
+    INDEX ix_refresh_job_institution (instcode, requested)
+);
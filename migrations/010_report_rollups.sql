@@ -0,0 +1,36 @@
+-- Rollups of each institution's report for the dashboard (MySQL)
+--   apply with: mysql <database> < migrations/010_report_rollups.sql
+--   institutions are counted on the dashboard from their first refresh after upgrading
+--   needs report_status, from migration 004; safe to apply whether or not the app has already created the tables
+
+-- report_status is created by migration 004 (without the column) or by the app (with it); MySQL has no ADD COLUMN
+--   IF NOT EXISTS, so look for it first
+SET @missing = (SELECT COUNT(*) = 0 FROM information_schema.columns
+                WHERE table_schema = DATABASE() AND table_name = 'report_status' AND column_name = 'in_transit');
+SET @statement = IF(@missing, 'ALTER TABLE report_status ADD COLUMN in_transit INTEGER NOT NULL DEFAULT 0', 'DO 0');
+PREPARE migration FROM @statement;
+EXECUTE migration;
+DEALLOCATE PREPARE migration;
+
+CREATE TABLE IF NOT EXISTS report_aging (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    generation BIGINT NOT NULL,
+    bucket INTEGER,
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_report_aging (instcode, generation, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS report_partner (
+    id BIGINT NOT NULL AUTO_INCREMENT,
+    instcode VARCHAR(255),
+    generation BIGINT NOT NULL,
+    partnercode VARCHAR(255),
+    partnername VARCHAR(255),
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (instcode) REFERENCES institution (code),
+    INDEX ix_report_partner (instcode, generation, partnercode)
+);
@@ -0,0 +1,7 @@
+-- Indexes for searching requests (MySQL)
+--   apply with: mysql <database> < migrations/011_request_search.sql
+
+CREATE INDEX ix_request_networknum ON request (networknum);
+CREATE INDEX ix_request_internalid ON request (internalid);
+CREATE INDEX ix_request_requestor ON request (requestor);
+CREATE FULLTEXT INDEX ix_request_fulltext ON request (title, author);
@@ -1,9 +1,16 @@
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
 from flask import flash, redirect, url_for
-from utils import db, exceptions_map
-from datetime import datetime
-from settings import admins
+from utils import db, exceptions_map, items_map, events_map, TTLCache
+from collections import namedtuple
+from datetime import datetime, timedelta
+from settings import admins, user_cache_ttl
+import threading
+import re
+import zlib
 
+# BigInteger primary key that still autoincrements on SQLite (used by the benchmarks)
+BigIntId = sa.BigInteger().with_variant(sa.Integer, 'sqlite')
 
 ####################
 #  Object Classes  #
@@ -26,91 +33,100 @@ class Institution(db.Model):
         self.items = items
         self.events = events
 
-    # Get all requests for an institution
-    def get_all_requests(self):
+    # Stream all rows of the materialized report for one generation of an institution's data, in download column
+    #   order; rows are fetched from a server-side cursor in batches rather than all at once
+    def get_all_requests(self, generation):
         requests = db.session.execute(db.select(
-            Request.borreqstat.label('Borrowing Request Status'),
-            Request.internalid.label('Internal ID'),
-            Request.borcreate.label('Borrowing Request Date'),
-            Request.title.label('Title'),
-            Request.author.label('Author'),
-            Request.networknum.label('Network Number'),
-            Request.partnerstat.label('Partner Active Status'),
-            Request.reqsend.label('Request Sending Date'),
-            Request.days.label('Days Since Request'),
-            Request.requestor.label('Requestor'),
-            Request.partnername.label('Partner Name'),
-            Request.partnercode.label('Partner Code'),
-            Event.eventstart.label('In Transit Start')
-        ).join(Item, Item.fulfillmentreqid == Request.fulfillmentreqid, isouter=True).join(
-            Event, Event.itemid == Item.itemid, isouter=True
+            Report_row.borreqstat.label('Borrowing Request Status'),
+            Report_row.internalid.label('Internal ID'),
+            Report_row.borcreate.label('Borrowing Request Date'),
+            Report_row.title.label('Title'),
+            Report_row.author.label('Author'),
+            Report_row.networknum.label('Network Number'),
+            Report_row.requestor.label('Requestor'),
+            Report_row.partnerstat.label('Partner Active Status'),
+            Report_row.reqsend.label('Request Sending Date'),
+            Report_row.days.label('Days Since Request'),
+            Report_row.partnername.label('Partner Name'),
+            Report_row.partnercode.label('Partner Code'),
+            Report_row.eventstart.label('In Transit Start')
         ).filter(
-            Request.instcode == self.code
+            Report_row.instcode == self.code,
+            Report_row.generation == generation
         ).order_by(
-            Request.borreqstat, Request.internalid.desc(), Request.borcreate.desc(), Request.reqsend.desc()
-        )).all()
+            Report_row.position
+        ).execution_options(yield_per=1000))
         return requests
 
-    # Get a single institution's requests by status from the database
-    def get_requests(self, status):
+    # Get a page of one status's rows of the materialized report for one generation of an institution's data
+    #   keyset pagination on position: rows after the given position, about limit of them but never splitting a
+    #   request's rows across pages; returns (rows, position to continue after, or None on the last page)
+    def get_report_page(self, generation, status, after, limit):
+        rows = []
+        while True:
+            batch = db.session.execute(db.select(
+                Report_row.position, *[getattr(Report_row, column) for column in report_columns],
+                Report_row.eventstart
+            ).filter(
+                Report_row.instcode == self.code,
+                Report_row.generation == generation,
+                Report_row.borreqstat == status,
+                Report_row.position > after
+            ).order_by(
+                Report_row.position
+            ).limit(limit)).all()
+
+            for row in batch:
+                if len(rows) >= limit and row.internalid != rows[-1].internalid:
+                    return rows, rows[-1].position  # page is full and the last request is complete
+                rows.append(row)
+            if len(batch) < limit:
+                return rows, None  # no more rows for this status
+            after = batch[-1].position
+
+    # Get the precomputed per-status counts of the materialized report for one generation of an institution's data
+    def get_report_statuses(self, generation):
+        statuses = db.session.execute(db.select(Report_status).filter(
+            Report_status.instcode == self.code,
+            Report_status.generation == generation
+        ).order_by(
+            Report_status.borreqstat
+        )).scalars().all()
+        return statuses
+
+    # Get a single institution's requests from one generation of its data, optionally only those with one status
+    def get_requests(self, generation, status=None):
         requests = db.session.execute(db.select(
             Request.borreqstat, Request.internalid, Request.borcreate, Request.title, Request.author,
             Request.networknum, Request.partnerstat, Request.reqsend, Request.days, Request.requestor,
             Request.partnername, Request.partnercode, Event.eventstart
-        ).join(Item, Item.fulfillmentreqid == Request.fulfillmentreqid, isouter=True).join(
-            Event, Event.itemid == Item.itemid, isouter=True
+        ).join(Item, report_item_join, isouter=True).join(
+            Event, report_event_join, isouter=True
         ).filter(
             Request.instcode == self.code,
-            Request.borreqstat == status
+            Request.generation == generation,
+            sa.true() if status is None else Request.borreqstat == status
         ).order_by(
             Request.borreqstat, Request.internalid.desc(), Request.borcreate.desc(), Request.reqsend.desc()
         )).all()
         return requests
 
-    # Get a single institution's borrowing request statuses from the database
-    def get_statuses(self):
+    # Get a single institution's borrowing request statuses from one generation of its data
+    def get_statuses(self, generation):
         statuses = db.session.execute(db.select(
             Request.borreqstat, sa.func.count(Request.borreqstat)
         ).filter(
-            Request.instcode == self.code
+            Request.instcode == self.code,
+            Request.generation == generation
         ).group_by(
             Request.borreqstat
         )).all()
         return statuses
 
-    # Construct a request object from a single row in the exceptions report
-    def construct_request(self, exrow):
-        exinstance = Request(None, None, None, None, None, None, None, None, None, None, None, None, None, None,
-                             self.code)
-
-        for key, value in exceptions_map.items():
-            try:
-                setattr(exinstance, key, exrow.find(value).get_text())
-            except AttributeError:
-                pass
-
-        return exinstance
-
-    # Construct an item object from a single row in the items report
-    def construct_item(self, itrow):
-        itemid = itrow.Column1.get_text()  # Item ID
-        fulfillmentreqid = itrow.Column2.get_text()  # Fulfillment request ID
-        itinstance = Item(itemid, fulfillmentreqid, self.code)  # Create a new item object
-
-        return itinstance
-
-    # Construct an event object from a single row in the events report
-    def construct_event(self, evrow):
-        itemid = evrow.Column2.get_text()  # Event type description
-        eventstart = evrow.Column1.get_text()  # Event start date
-        evinstance = Event(itemid, eventstart, self.code)  # Create a new event object
-
-        return evinstance
-
 
 # Request object
 class Request(db.Model):
-    id = sa.Column(sa.BigInteger, primary_key=True)
+    id = sa.Column(BigIntId, primary_key=True)
     fulfillmentreqid = sa.Column(sa.String(255), nullable=True)
     requestorid = sa.Column(sa.String(255), nullable=True)
     borreqstat = sa.Column(sa.String(255), nullable=True)
@@ -126,10 +142,22 @@ class Request(db.Model):
     partnername = sa.Column(sa.String(255), nullable=True)
     partnercode = sa.Column(sa.String(255), nullable=True)
     instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+    rowhash = sa.Column(sa.String(32), nullable=True)  # content hash, for incremental refreshes
+
+    __table_args__ = (
+        # Report queries: filter on institution, generation and status, then sort by internal ID and creation date
+        sa.Index('ix_request_report', instcode, generation, borreqstat, internalid.desc(), borcreate.desc()),
+        # Search: exact network number and internal ID, requestor prefix, and words of the title and author
+        sa.Index('ix_request_networknum', networknum),
+        sa.Index('ix_request_internalid', internalid),
+        sa.Index('ix_request_requestor', requestor),
+        sa.Index('ix_request_fulltext', title, author, mysql_prefix='FULLTEXT'),
+    )
 
     def __init__(
         self, fulfillmentreqid, requestorid, borreqstat, internalid, borcreate, title, author, networknum, partnerstat,
-        reqsend, days, requestor, partnername, partnercode, instcode
+        reqsend, days, requestor, partnername, partnercode, instcode, generation=0
     ):
         self.fulfillmentreqid = fulfillmentreqid
         self.requestorid = requestorid
@@ -146,47 +174,235 @@ class Request(db.Model):
         self.partnername = partnername
         self.partnercode = partnercode
         self.instcode = instcode
+        self.generation = generation
 
 
 # Item object
 class Item(db.Model):
-    id = sa.Column(sa.BigInteger, primary_key=True)
+    id = sa.Column(BigIntId, primary_key=True)
     itemid = sa.Column(sa.String(255), nullable=False)
     fulfillmentreqid = sa.Column(sa.String(255), nullable=False)
     instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+    rowhash = sa.Column(sa.String(32), nullable=True)  # content hash, for incremental refreshes
 
-    def __init__(self, itemid, fulfillmentreqid, instcode):
+    __table_args__ = (
+        sa.Index('ix_item_request', instcode, generation, fulfillmentreqid),  # join from a request to its items
+    )
+
+    def __init__(self, itemid, fulfillmentreqid, instcode, generation=0):
         self.itemid = itemid
         self.fulfillmentreqid = fulfillmentreqid
         self.instcode = instcode
+        self.generation = generation
 
 
 # Event object
 class Event(db.Model):
-    id = sa.Column(sa.BigInteger, primary_key=True)
+    id = sa.Column(BigIntId, primary_key=True)
     itemid = sa.Column(sa.String(255), nullable=False)
     eventstart = sa.Column(sa.DateTime, nullable=False)
     instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+    rowhash = sa.Column(sa.String(32), nullable=True)  # content hash, for incremental refreshes
+
+    __table_args__ = (
+        sa.Index('ix_event_item', instcode, generation, itemid),  # join from an item to its events
+    )
 
-    def __init__(self, itemid, eventstart, instcode):
+    def __init__(self, itemid, eventstart, instcode, generation=0):
         self.itemid = itemid
         self.eventstart = eventstart
         self.instcode = instcode
+        self.generation = generation
 
 
+# Refresh history; the latest row for an institution points at the generation of its data that readers see
 class Inst_update(db.Model):
-    id = sa.Column(sa.BigInteger, primary_key=True)
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    last_update = sa.Column(sa.DateTime, nullable=False)
+    generation = sa.Column(sa.BigInteger, nullable=False, server_default='0')
+
+    __table_args__ = (
+        sa.Index('ix_inst_update_latest', instcode, last_update),  # latest update per institution
+    )
+
+    def __init__(self, instcode, last_update, generation=0):
+        self.instcode = instcode
+        self.last_update = last_update
+        self.generation = generation
+
+
+# Materialized report: one generation of an institution's requests joined to their items' events, pre-sorted
+class Report_row(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
     instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False)
+    position = sa.Column(sa.BigInteger, nullable=False)  # row number in report order
+    borreqstat = sa.Column(sa.String(255), nullable=True)
+    internalid = sa.Column(sa.String(255), nullable=True)
+    borcreate = sa.Column(sa.Date, nullable=True)
+    title = sa.Column(sa.String(510), nullable=True)
+    author = sa.Column(sa.String(255), nullable=True)
+    networknum = sa.Column(sa.String(255), nullable=True)
+    partnerstat = sa.Column(sa.String(255), nullable=True)
+    reqsend = sa.Column(sa.DateTime, nullable=True)
+    days = sa.Column(sa.Integer, nullable=True)
+    requestor = sa.Column(sa.String(255), nullable=True)
+    partnername = sa.Column(sa.String(255), nullable=True)
+    partnercode = sa.Column(sa.String(255), nullable=True)
+    eventstart = sa.Column(sa.DateTime, nullable=True)
+
+    __table_args__ = (
+        sa.Index('ix_report_row_position', instcode, generation, position),  # report order range scans
+        sa.Index('ix_report_row_status', instcode, generation, borreqstat, position),  # one status's pages
+    )
+
+
+# Materialized per-status counts for one generation of an institution's report
+class Report_status(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False)
+    borreqstat = sa.Column(sa.String(255), nullable=True)
+    requests = sa.Column(sa.Integer, nullable=False)  # distinct internal IDs
+    rows = sa.Column(sa.Integer, nullable=False)
+    in_transit = sa.Column(sa.Integer, nullable=False, server_default='0')  # distinct internal IDs with an event
+
+    __table_args__ = (
+        sa.Index('ix_report_status', instcode, generation, borreqstat),
+    )
+
+
+# Materialized request counts per aging bucket for one generation of an institution's report
+#   a request's age is the most days since any of its partner requests was sent
+class Report_aging(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False)
+    bucket = sa.Column(sa.Integer, nullable=True)  # the bucket's fewest days (see aging_buckets); None if unknown
+    requests = sa.Column(sa.Integer, nullable=False)
+
+    __table_args__ = (
+        sa.Index('ix_report_aging', instcode, generation, bucket),
+    )
+
+
+# Materialized per-partner counts for one generation of an institution's report
+class Report_partner(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    generation = sa.Column(sa.BigInteger, nullable=False)
+    partnercode = sa.Column(sa.String(255), nullable=True)
+    partnername = sa.Column(sa.String(255), nullable=True)
+    requests = sa.Column(sa.Integer, nullable=False)  # distinct internal IDs
+
+    __table_args__ = (
+        sa.Index('ix_report_partner', instcode, generation, partnercode),
+    )
+
+
+# Latest update per institution, kept alongside the Inst_update history so reading it is a primary key lookup
+class Latest_update(db.Model):
+    instcode = sa.Column(sa.ForeignKey(Institution.code), primary_key=True)
     last_update = sa.Column(sa.DateTime, nullable=False)
+    generation = sa.Column(sa.BigInteger, nullable=False)  # the generation of the institution's data readers see
 
-    def __init__(self, instcode, last_update):
+    def __init__(self, instcode, last_update, generation):
         self.instcode = instcode
         self.last_update = last_update
+        self.generation = generation
+
+
+# Lease that elects one process in the deployment to run a scheduled job (e.g. the report refresh)
+class Scheduler_lease(db.Model):
+    name = sa.Column(sa.String(64), primary_key=True)
+    holder = sa.Column(sa.String(255), nullable=False)  # host:pid of the process holding the lease
+    acquired = sa.Column(sa.DateTime, nullable=False)  # when the current holder took it
+    expires = sa.Column(sa.DateTime, nullable=False)  # when another process may take it over
+
+    def __init__(self, name, holder, acquired, expires):
+        self.name = name
+        self.holder = holder
+        self.acquired = acquired
+        self.expires = expires
+
+
+# Timings and sizes of one report's part in one institution's refresh
+class Refresh_stat(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    report = sa.Column(sa.String(32), nullable=False)  # exceptions, items or events
+    started = sa.Column(sa.DateTime, nullable=False)  # when the refresh started; shared by its reports
+    pages = sa.Column(sa.Integer, nullable=False)
+    bytes = sa.Column(sa.BigInteger, nullable=False)
+    rows = sa.Column(sa.Integer, nullable=False)
+    fetch_seconds = sa.Column(sa.Float, nullable=False)  # waiting on Alma
+    parse_seconds = sa.Column(sa.Float, nullable=False)  # parsing and decoding the XML
+    write_seconds = sa.Column(sa.Float, nullable=False)  # writing the rows to the database
+    failed = sa.Column(sa.Boolean, nullable=False)  # the refresh failed before this report was loaded
+    unchanged = sa.Column(sa.Boolean, nullable=False, server_default=sa.false())  # same as last time, so not loaded
+
+    __table_args__ = (
+        sa.Index('ix_refresh_stat_latest', instcode, started),  # latest refresh per institution
+    )
+
+    def __init__(self, instcode, report, started, pages, bytes, rows, fetch_seconds, parse_seconds, write_seconds,
+                 failed, unchanged=False):
+        self.instcode = instcode
+        self.report = report
+        self.started = started
+        self.pages = pages
+        self.bytes = bytes
+        self.rows = rows
+        self.fetch_seconds = fetch_seconds
+        self.parse_seconds = parse_seconds
+        self.write_seconds = write_seconds
+        self.failed = failed
+        self.unchanged = unchanged
+
+
+# When an institution's reports are next refreshed, and how often
+class Refresh_schedule(db.Model):
+    instcode = sa.Column(sa.ForeignKey(Institution.code), primary_key=True)
+    interval = sa.Column(sa.Integer, nullable=False)  # seconds between refreshes, adapted after each one
+    next_refresh = sa.Column(sa.DateTime, nullable=False, index=True)
+    target = sa.Column(sa.Integer, nullable=False)  # freshness target: the longest interval allowed, in seconds
+
+    def __init__(self, instcode, interval, next_refresh, target):
+        self.instcode = instcode
+        self.interval = interval
+        self.next_refresh = next_refresh
+        self.target = target
+
+
+# On-demand refresh of one institution, queued until the scheduler leader runs it
+class Refresh_job(db.Model):
+    id = sa.Column(BigIntId, primary_key=True)
+    instcode = sa.Column(sa.ForeignKey(Institution.code))
+    requested_by = sa.Column(sa.String(255), nullable=True)
+    requested = sa.Column(sa.DateTime, nullable=False)
+    started = sa.Column(sa.DateTime, nullable=True)
+    finished = sa.Column(sa.DateTime, nullable=True)
+    status = sa.Column(sa.String(16), nullable=False)  # queued, running, done or failed
+    progress = sa.Column(sa.String(64), nullable=True)  # the refresh's current step while it's running
+
+    __table_args__ = (
+        sa.Index('ix_refresh_job_status', status, id),  # the queue
+        sa.Index('ix_refresh_job_institution', instcode, requested),  # an institution's latest job
+    )
+
+    def __init__(self, instcode, requested_by, requested):
+        self.instcode = instcode
+        self.requested_by = requested_by
+        self.requested = requested
+        self.status = 'queued'
 
 
 class User(db.Model):
     id = sa.Column(sa.Integer, primary_key=True)
-    username = sa.Column(sa.String(255), nullable=False)
+    username = sa.Column(sa.String(255), nullable=False, index=True)  # login lookups
     displayname = sa.Column(sa.String(255), nullable=True)
     instcode = sa.Column(sa.ForeignKey(Institution.code))
     admin = sa.Column(sa.Boolean, nullable=False)
@@ -200,10 +416,161 @@ class User(db.Model):
         self.last_login = last_login
 
 
+# The parts of a user's record that logging in needs, as kept in the user cache
+User_record = namedtuple('User_record', ('username', 'admin', 'instcode'))
+
+# Recently logged in users' records, by username, so logins don't have to look them up
+user_cache = TTLCache(user_cache_ttl, 10000)
+
+# Last login times not yet written to the database, by username
+pending_logins = {}
+pending_logins_lock = threading.Lock()  # shared by the request threads and the flush job
+
+
+# Join conditions from a request to its items and from an item to its events, within one generation
+report_item_join = sa.and_(
+    Item.fulfillmentreqid == Request.fulfillmentreqid, Item.instcode == Request.instcode,
+    Item.generation == Request.generation
+)
+report_event_join = sa.and_(
+    Event.itemid == Item.itemid, Event.instcode == Item.instcode, Event.generation == Item.generation
+)
+
+# Report order: by status, then newest internal ID, creation date and sending date first
+report_order = (Request.borreqstat, Request.internalid.desc(), Request.borcreate.desc(), Request.reqsend.desc())
+
+# Columns copied from the request/item/event join into the materialized report
+report_columns = (
+    'borreqstat', 'internalid', 'borcreate', 'title', 'author', 'networknum', 'partnerstat', 'reqsend', 'days',
+    'requestor', 'partnername', 'partnercode'
+)
+
+# Report columns shared by all of a request's rows, and those that differ per partner
+request_group_columns = (
+    'borreqstat', 'internalid', 'borcreate', 'title', 'author', 'networknum', 'requestor', 'eventstart'
+)
+partner_columns = ('partnerstat', 'reqsend', 'days', 'partnername', 'partnercode')
+
+# Words InnoDB leaves out of full-text indexes: its default stopword list, and its default innodb_ft_min_token_size
+fulltext_stopwords = frozenset((
+    'a', 'about', 'an', 'are', 'as', 'at', 'be', 'by', 'com', 'de', 'en', 'for', 'from', 'how', 'i', 'in', 'is', 'it',
+    'la', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'who', 'will', 'with', 'und',
+    'www'
+))
+fulltext_min_length = 3
+
+# Aging buckets of the dashboard, by the fewest days since request in each; the last is open-ended
+aging_buckets = (0, 7, 14, 30, 60, 90)
+
+# Column order of the row tuples decoded from the exceptions, items and events reports
+request_columns = tuple(exceptions_map)
+item_columns = tuple(items_map)
+event_columns = tuple(events_map)
+
+# Stable identity of a row from one refresh to the next, for incremental refreshes
+request_keys = ('fulfillmentreqid', 'internalid')
+item_keys = ('itemid',)
+event_keys = ('itemid',)
+
+
 ####################
 #  Helper Methods  #
 ####################
 
+# Group report rows by request (consecutive rows with the same internal ID), the way the report table merges them
+#   request-level values come from the request's first row; partner values are kept per row
+def group_by_request(rows):
+    requests = []
+    for row in rows:
+        if not requests or requests[-1]['internalid'] != row.internalid:
+            requests.append({column: report_value(getattr(row, column)) for column in request_group_columns})
+            requests[-1]['partners'] = []
+        requests[-1]['partners'].append({column: report_value(getattr(row, column)) for column in partner_columns})
+    return requests
+
+
+# Format a report value the way the report page displays it
+def report_value(value):
+    if value is None or isinstance(value, (str, int)):
+        return value
+    return str(value)  # dates and timestamps
+
+
+# Label an aging bucket for display
+def aging_label(bucket):
+    if bucket is None:
+        return 'Unknown'
+    following = [lower for lower in aging_buckets if lower > bucket]
+    return f'{bucket}-{following[0] - 1} days' if following else f'{bucket}+ days'
+
+
+# Build the materialized report and its rollups (status, aging and partner counts) for one generation of an
+#   institution's data (no commit); any report already built for that generation is replaced
+def build_report(instcode, generation):
+    for obtype in (Report_row, Report_status, Report_aging, Report_partner):
+        db.session.execute(sa.delete(obtype).where(obtype.instcode == instcode, obtype.generation == generation))
+
+    # Requests joined to their items' events, numbered in report order; a missing status becomes '', so its rows can
+    #   be asked for by status like any other's (NULL would never compare equal)
+    columns = [getattr(Request, column) for column in report_columns]
+    columns[report_columns.index('borreqstat')] = sa.func.coalesce(Request.borreqstat, '')
+    rows = db.select(
+        Request.instcode, Request.generation, sa.func.row_number().over(order_by=report_order), *columns,
+        Event.eventstart
+    ).join(Item, report_item_join, isouter=True).join(
+        Event, report_event_join, isouter=True
+    ).filter(
+        Request.instcode == instcode,
+        Request.generation == generation
+    )
+    db.session.execute(sa.insert(Report_row).from_select(
+        ('instcode', 'generation', 'position') + report_columns + ('eventstart',), rows))
+
+    # Distinct requests, rows and requests in transit per status
+    in_transit = sa.case((Report_row.eventstart.is_not(None), Report_row.internalid))
+    statuses = db.select(
+        Report_row.instcode, Report_row.generation, Report_row.borreqstat,
+        sa.func.count(sa.distinct(Report_row.internalid)), sa.func.count(), sa.func.count(sa.distinct(in_transit))
+    ).filter(
+        Report_row.instcode == instcode,
+        Report_row.generation == generation
+    ).group_by(
+        Report_row.instcode, Report_row.generation, Report_row.borreqstat
+    )
+    db.session.execute(sa.insert(Report_status).from_select(
+        ('instcode', 'generation', 'borreqstat', 'requests', 'rows', 'in_transit'), statuses))
+
+    # Requests per aging bucket, by each request's oldest partner request
+    ages = db.select(sa.func.max(Report_row.days).label('days')).filter(
+        Report_row.instcode == instcode,
+        Report_row.generation == generation
+    ).group_by(
+        Report_row.internalid
+    ).subquery()
+    bucketed = db.select(sa.case(
+        *[(ages.c.days >= lower, lower) for lower in reversed(aging_buckets[1:])],
+        (ages.c.days.is_not(None), aging_buckets[0])
+    ).label('bucket')).subquery()  # grouped by name rather than by the expression, which MySQL can't match up
+    buckets = db.select(
+        sa.literal(instcode), sa.literal(generation), bucketed.c.bucket, sa.func.count()
+    ).group_by(bucketed.c.bucket)
+    db.session.execute(sa.insert(Report_aging).from_select(
+        ('instcode', 'generation', 'bucket', 'requests'), buckets))
+
+    # Distinct requests per partner
+    partners = db.select(
+        Report_row.instcode, Report_row.generation, Report_row.partnercode, sa.func.max(Report_row.partnername),
+        sa.func.count(sa.distinct(Report_row.internalid))
+    ).filter(
+        Report_row.instcode == instcode,
+        Report_row.generation == generation
+    ).group_by(
+        Report_row.instcode, Report_row.generation, Report_row.partnercode
+    )
+    db.session.execute(sa.insert(Report_partner).from_select(
+        ('instcode', 'generation', 'partnercode', 'partnername', 'requests'), partners))
+
+
 # Get a list of all institutions from the database
 def get_all_institutions():
     institutions = db.session.execute(db.select(Institution).order_by(Institution.name)).scalars()
@@ -262,10 +629,47 @@ def check_user(username):
     return user
 
 
-# Set the last login time for the user
-def set_last_login(user):
-    user.last_login = datetime.now()  # Set the last login time to the current time
-    db.session.commit()  # Commit the changes
+# Get the parts of a user's record that logging in needs, from the user cache or else the database
+#   None if the user isn't in the database
+def get_user_record(username):
+    record = user_cache.get(username)
+    if record is None:
+        user = check_user(username)
+        if user is None:
+            return None  # not cached, so they're added as soon as they log in
+        record = User_record(user.username, user.admin, user.instcode)
+        user_cache.set(username, record)
+    return record
+
+
+# Set the last login time for the user; it's buffered and written by flush_last_logins
+def set_last_login(username):
+    with pending_logins_lock:
+        pending_logins[username] = datetime.now()  # Set the last login time to the current time
+
+
+# Write the buffered last login times to the database in one executemany UPDATE, returning how many were written
+def flush_last_logins():
+    with pending_logins_lock:
+        logins = dict(pending_logins)
+        pending_logins.clear()
+    if not logins:
+        return 0
+
+    table = User.__table__
+    statement = sa.update(table).where(table.c.username == sa.bindparam('b_username')).values(
+        last_login=sa.bindparam('b_last_login'))
+    try:
+        db.session.execute(statement, [
+            {'b_username': username, 'b_last_login': last_login} for username, last_login in logins.items()])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with pending_logins_lock:
+            for username, last_login in logins.items():
+                pending_logins.setdefault(username, last_login)  # try again next time, unless they've logged in since
+        raise
+    return len(logins)
 
 
 # Set the user's admin status based on the database
@@ -293,6 +697,7 @@ def add_user(session, admincheck):
     user = User(session['username'], session['display_name'], session['user_home'], admincheck, datetime.now())
     db.session.add(user)  # Add the user to the database
     db.session.commit()  # Commit the changes
+    user_cache.set(user.username, User_record(user.username, user.admin, user.instcode))
 
 
 # Log the user in
@@ -304,13 +709,13 @@ def user_login(session, user_data):
     session['display_name'] = user_data['full_name']  # Set the user's display name
     session['authorizations'] = user_data['authorizations']  # Set the user's authorizations
 
-    user = check_user(session['username'])  # Check if the user exists in the database
+    user = get_user_record(session['username'])  # Check if the user exists in the database
 
     # If the user is in the database...
     if user is not None:
         set_user_admin(user, session)  # ..set the user's admin status
         if 'exceptions' in session['authorizations']:
-            set_last_login(user)  # ..set the last login time for the user
+            set_last_login(user.username)  # ..set the last login time for the user
 
     # If the user isn't in the database...
     else:
@@ -318,22 +723,373 @@ def user_login(session, user_data):
         add_user(session, admincheck)  # ...add the user to the database
 
 
-# Add an update to the database
-def add_update(instcode, last_update):
-    update = Inst_update(instcode, last_update)  # Create the update object
-    db.session.add(update)  # Add the update to the database
+# Add an update to the database, making its generation of the institution's data the one readers see
+def add_update(instcode, last_update, generation=0):
+    update = Inst_update(instcode, last_update, generation)  # Create the update object
+    db.session.add(update)  # Add the update to the history
+    db.session.merge(Latest_update(instcode, last_update, generation))  # Replace the institution's latest update
     db.session.commit()  # Commit the changes
 
 
+# Delete refresh history (updates, refresh statistics and finished refresh jobs) from before a cutoff; each
+#   institution's latest update is kept in Latest_update
+def prune_updates(cutoff):
+    result = db.session.execute(sa.delete(Inst_update).where(Inst_update.last_update < cutoff))
+    db.session.execute(sa.delete(Refresh_stat).where(Refresh_stat.started < cutoff))
+    db.session.execute(sa.delete(Refresh_job).where(
+        Refresh_job.requested < cutoff, Refresh_job.status.in_(('done', 'failed'))))  # not jobs yet to finish
+    db.session.commit()
+    return result.rowcount
+
+
+# Record the statistics of an institution's refresh, one row per report it reached
+#   stats maps each report to a dict of pages, bytes, rows, fetch_seconds, parse_seconds, write_seconds, failed and
+#   unchanged
+def add_refresh_stats(instcode, started, stats):
+    db.session.add_all(Refresh_stat(
+        instcode, report, started, int(values['pages']), int(values['bytes']), int(values['rows']),
+        values['fetch_seconds'], values['parse_seconds'], values['write_seconds'], bool(values['failed']),
+        bool(values['unchanged'])
+    ) for report, values in stats.items())
+    db.session.commit()
+
+
+# Get the statistics of each institution's latest refresh, in institution and report order
+def get_latest_refresh_stats():
+    latest = db.select(Refresh_stat.instcode, sa.func.max(Refresh_stat.started).label('started')).group_by(
+        Refresh_stat.instcode).subquery()
+    stats = db.session.execute(db.select(Refresh_stat).join(
+        latest, sa.and_(latest.c.instcode == Refresh_stat.instcode, latest.c.started == Refresh_stat.started)
+    ).order_by(Refresh_stat.instcode, Refresh_stat.id)).scalars().all()
+    return stats
+
+
+# Add refresh schedules, given as (instcode, interval, next_refresh, target), for institutions that don't have one
+def add_schedules(schedules):
+    existing = set(db.session.execute(db.select(Refresh_schedule.instcode)).scalars())
+    db.session.add_all(Refresh_schedule(*schedule) for schedule in schedules if schedule[0] not in existing)
+    db.session.commit()
+
+
+# Get the refresh schedules that are due, most overdue first
+def get_due_schedules(now):
+    schedules = db.session.execute(db.select(Refresh_schedule).filter(
+        Refresh_schedule.next_refresh <= now
+    ).order_by(Refresh_schedule.next_refresh)).scalars().all()
+    return schedules
+
+
+# Set an institution's refresh interval and next refresh
+def set_schedule(instcode, interval, next_refresh):
+    db.session.execute(sa.update(Refresh_schedule).where(Refresh_schedule.instcode == instcode).values(
+        interval=interval, next_refresh=next_refresh))
+    db.session.commit()
+
+
+# Get all institutions with their refresh schedules and latest updates (either None if there isn't one yet), in the
+#   order they're next due
+def get_schedules():
+    schedules = db.session.execute(
+        db.select(Institution, Refresh_schedule, Latest_update.last_update).join(
+            Refresh_schedule, Refresh_schedule.instcode == Institution.code, isouter=True
+        ).join(
+            Latest_update, Latest_update.instcode == Institution.code, isouter=True
+        ).order_by(Refresh_schedule.next_refresh, Institution.name)).all()
+    return schedules
+
+
+# Get the number of Alma API calls (report pages fetched) made by refreshes since a time
+def get_api_calls_since(since):
+    calls = db.session.execute(db.select(sa.func.coalesce(sa.func.sum(Refresh_stat.pages), 0)).filter(
+        Refresh_stat.started >= since)).scalar_one()
+    return int(calls)
+
+
+# Get an institution's refresh schedule, or None if it hasn't got one yet
+def get_schedule(instcode):
+    schedule = db.session.get(Refresh_schedule, instcode)
+    return schedule
+
+
+# Queue an on-demand refresh of an institution, unless one is already queued or running
+#   returns (job, whether it was added)
+def add_refresh_job(instcode, requested_by):
+    job = get_pending_refresh_job(instcode)
+    if job is not None:
+        return job, False
+    job = Refresh_job(instcode, requested_by, datetime.now())
+    db.session.add(job)
+    db.session.commit()
+    return job, True
+
+
+# Get an institution's queued or running refresh job, or None
+def get_pending_refresh_job(instcode):
+    job = db.session.execute(db.select(Refresh_job).filter(
+        Refresh_job.instcode == instcode,
+        Refresh_job.status.in_(('queued', 'running'))
+    ).order_by(Refresh_job.id).limit(1)).scalar_one_or_none()
+    return job
+
+
+# Get an institution's most recently requested refresh job, or None
+def get_latest_refresh_job(instcode):
+    job = db.session.execute(db.select(Refresh_job).filter(
+        Refresh_job.instcode == instcode
+    ).order_by(Refresh_job.requested.desc()).limit(1)).scalar_one_or_none()
+    return job
+
+
+# Get a refresh job by ID, or None
+def get_refresh_job(job_id):
+    job = db.session.get(Refresh_job, job_id)
+    return job
+
+
+# Get a queued job's place in the queue (1 is next), or None if it isn't queued
+def get_refresh_job_position(job):
+    if job.status != 'queued':
+        return None
+    ahead = db.session.execute(db.select(sa.func.count()).select_from(Refresh_job).filter(
+        Refresh_job.status == 'queued', Refresh_job.id < job.id)).scalar_one()
+    return ahead + 1
+
+
+# Take the next queued refresh, marking every queued job for its institution as running; returns the institution
+#   code, or None if the queue is empty
+def claim_refresh_job():
+    job = db.session.execute(db.select(Refresh_job).filter(
+        Refresh_job.status == 'queued').order_by(Refresh_job.id).limit(1)).scalar_one_or_none()
+    if job is None:
+        return None
+    instcode = job.instcode
+    claimed = db.session.execute(sa.update(Refresh_job).where(
+        Refresh_job.instcode == instcode, Refresh_job.status == 'queued'
+    ).values(status='running', started=datetime.now(), progress='starting'))
+    db.session.commit()
+    return instcode if claimed.rowcount > 0 else None
+
+
+# Record the step an institution's running refresh jobs have reached
+#   uses its own connection and transaction, since the refresh's own transaction isn't committed until it's done;
+#   SQLite only allows one writer at a time, and the refresh is it, so there progress isn't recorded
+def set_refresh_job_progress(instcode, progress):
+    if db.engine.dialect.name == 'sqlite':
+        return
+    with db.engine.begin() as connection:
+        connection.execute(sa.update(Refresh_job).where(
+            Refresh_job.instcode == instcode, Refresh_job.status == 'running').values(progress=progress))
+
+
+# Finish an institution's running refresh jobs
+def finish_refresh_jobs(instcode, ok):
+    db.session.execute(sa.update(Refresh_job).where(
+        Refresh_job.instcode == instcode, Refresh_job.status == 'running'
+    ).values(status='done' if ok else 'failed', finished=datetime.now(), progress=None))
+    db.session.commit()
+
+
+# Fail running refresh jobs that started before a cutoff, e.g. because the process running them died
+def expire_refresh_jobs(cutoff):
+    result = db.session.execute(sa.update(Refresh_job).where(
+        Refresh_job.status == 'running', Refresh_job.started < cutoff
+    ).values(status='failed', finished=datetime.now(), progress=None))
+    db.session.commit()
+    return result.rowcount
+
+
+# Check whether a process holds an unexpired lease, without renewing it
+def holds_lease(name, holder):
+    lease = db.session.execute(db.select(Scheduler_lease).filter(
+        Scheduler_lease.name == name, Scheduler_lease.holder == holder, Scheduler_lease.expires >= datetime.now()
+    )).scalar_one_or_none()
+    return lease is not None
+
+
+# Get the generation of an institution's data that readers should see
+def get_current_generation(instcode):
+    update = get_last_update(instcode)
+    if update is None:
+        return 0  # never refreshed; rows loaded before generations existed are generation 0
+    return update.generation
+
+
+# Get an institution's latest update, or None if it has never been refreshed
 def get_last_update(instcode):
-    update = db.session.execute(
-        db.select(Inst_update).filter(Inst_update.instcode == instcode).order_by(sa.desc(
-            Inst_update.last_update))).first()
+    update = db.session.get(Latest_update, instcode)
     return update
 
 
-def get_all_last_updates():
-    updates = db.session.execute(
-        db.select(Inst_update.instcode, sa.func.max(Inst_update.last_update).label('last_update')).group_by(
-            Inst_update.instcode)).all()
-    return updates
+# Get all institutions with the time of their latest update (None if never refreshed), in name order
+def get_all_institutions_updated():
+    institutions = db.session.execute(
+        db.select(Institution, Latest_update.last_update).join(
+            Latest_update, Latest_update.instcode == Institution.code, isouter=True
+        ).order_by(Institution.name)).all()
+    return institutions
+
+
+# Get each institution's request and in-transit totals from its published report, with the time of its latest
+#   update, in name order; institutions that have never been refreshed have no totals
+def get_dashboard_institutions():
+    institutions = db.session.execute(db.select(
+        Institution.code, Institution.name, Latest_update.last_update,
+        sa.func.sum(Report_status.requests).label('requests'), sa.func.sum(Report_status.in_transit).label('in_transit')
+    ).join(
+        Latest_update, Latest_update.instcode == Institution.code, isouter=True
+    ).join(
+        Report_status, sa.and_(
+            Report_status.instcode == Latest_update.instcode, Report_status.generation == Latest_update.generation
+        ), isouter=True
+    ).group_by(
+        Institution.code, Institution.name, Latest_update.last_update
+    ).order_by(Institution.name)).all()
+    return institutions
+
+
+# Get the request, row and in-transit counts per status across every institution's published report
+def get_dashboard_statuses():
+    statuses = db.session.execute(db.select(
+        Report_status.borreqstat, sa.func.sum(Report_status.requests).label('requests'),
+        sa.func.sum(Report_status.rows).label('rows'), sa.func.sum(Report_status.in_transit).label('in_transit'),
+        sa.func.count().label('institutions')
+    ).join(
+        Latest_update, sa.and_(
+            Latest_update.instcode == Report_status.instcode, Latest_update.generation == Report_status.generation
+        )
+    ).group_by(
+        Report_status.borreqstat
+    ).order_by(Report_status.borreqstat)).all()
+    return statuses
+
+
+# Get the requests per aging bucket across every institution's published report, youngest bucket first
+def get_dashboard_aging():
+    buckets = db.session.execute(db.select(
+        Report_aging.bucket, sa.func.sum(Report_aging.requests).label('requests')
+    ).join(
+        Latest_update, sa.and_(
+            Latest_update.instcode == Report_aging.instcode, Latest_update.generation == Report_aging.generation
+        )
+    ).group_by(
+        Report_aging.bucket
+    ).order_by(Report_aging.bucket.is_(None), Report_aging.bucket)).all()
+    return buckets
+
+
+# Get the partners with the most requests across every institution's published report, with how many institutions
+#   have requests with each
+def get_dashboard_partners(limit):
+    partners = db.session.execute(db.select(
+        Report_partner.partnercode, sa.func.max(Report_partner.partnername).label('partnername'),
+        sa.func.sum(Report_partner.requests).label('requests'), sa.func.count().label('institutions')
+    ).join(
+        Latest_update, sa.and_(
+            Latest_update.instcode == Report_partner.instcode, Latest_update.generation == Report_partner.generation
+        )
+    ).group_by(
+        Report_partner.partnercode
+    ).order_by(sa.func.sum(Report_partner.requests).desc(), Report_partner.partnercode).limit(limit)).all()
+    return partners
+
+
+# Boolean mode full-text search terms requiring every word of a query, as a word or the start of one
+#   InnoDB doesn't index stopwords or words shorter than innodb_ft_min_token_size, but a required prefix term is
+#   looked up even so, and then matches nothing; such words are left out
+def fulltext_terms(query):
+    words = [word for word in re.findall(r'\w+', query.lower())
+             if len(word) >= fulltext_min_length and word not in fulltext_stopwords]
+    return ' '.join(f'+{word}*' for word in words)
+
+
+# Search the published requests of the given institutions (or all of them, if codes is None) by exact network number
+#   or internal ID, requestor prefix, or words of the title or author; keyset pagination on id: about limit rows with
+#   ids after the given id, returning (rows, id to continue after, or None on the last page)
+#   each kind of match is looked up on its own index, at most limit + 1 ids each, and the results merged
+def search_requests(query, codes, after, limit):
+    if db.engine.dialect.name == 'mysql':
+        terms = fulltext_terms(query)
+        if terms:
+            text = mysql.match(Request.title, Request.author, against=terms).in_boolean_mode()
+        else:
+            text = sa.false()  # nothing that's in the index
+    else:
+        text = sa.or_(Request.title.contains(query, autoescape=True), Request.author.contains(query, autoescape=True))
+    matches = (
+        Request.networknum == query,
+        Request.internalid == query,
+        Request.requestor.startswith(query, autoescape=True),
+        text,
+    )
+
+    ids = []
+    for match in matches:
+        branch = db.select(Request.id).join(
+            Latest_update, sa.and_(
+                Latest_update.instcode == Request.instcode, Latest_update.generation == Request.generation
+            )
+        ).filter(match, Request.id > after)
+        if codes is not None:
+            branch = branch.filter(Request.instcode.in_(codes))
+        ids.append(db.select(branch.order_by(Request.id).limit(limit + 1).subquery().c.id))
+    found = sa.union(*ids).subquery()
+
+    rows = db.session.execute(db.select(
+        Request.id, Request.instcode, Institution.name, *[getattr(Request, column) for column in report_columns]
+    ).join(
+        found, found.c.id == Request.id
+    ).join(
+        Institution, Institution.code == Request.instcode
+    ).order_by(Request.id).limit(limit + 1)).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+# Token identifying the published generations of the given institutions (or all of them, if codes is None), which
+#   search result ids are only ordered within: snapshot refreshes reinsert every row with new ids
+def get_search_version(codes):
+    statement = db.select(Latest_update.instcode, Latest_update.generation).order_by(Latest_update.instcode)
+    if codes is not None:
+        statement = statement.filter(Latest_update.instcode.in_(codes))
+    generations = db.session.execute(statement).all()
+    return format(zlib.crc32(repr([tuple(row) for row in generations]).encode()), '08x')
+
+
+# Take or renew a lease for a process, returning whether it now holds it
+#   the lease is free once its holder hasn't renewed it for ttl seconds
+def acquire_lease(name, holder, ttl):
+    now = datetime.now()
+    renewed = db.session.execute(sa.update(Scheduler_lease).where(
+        Scheduler_lease.name == name,
+        sa.or_(Scheduler_lease.holder == holder, Scheduler_lease.expires < now)
+    ).ordered_values(
+        # acquired first: MySQL assigns left to right, so later assignments see holder already changed
+        (Scheduler_lease.acquired, sa.case((Scheduler_lease.holder == holder, Scheduler_lease.acquired), else_=now)),
+        (Scheduler_lease.holder, holder),
+        (Scheduler_lease.expires, now + timedelta(seconds=ttl))
+    ))
+    if renewed.rowcount == 1:
+        db.session.commit()
+        return True
+
+    # Nobody has ever held it, or someone else holds it
+    try:
+        db.session.add(Scheduler_lease(name, holder, now, now + timedelta(seconds=ttl)))
+        db.session.commit()
+        return True
+    except sa.exc.IntegrityError:
+        db.session.rollback()  # someone else holds it (or just took it)
+        return False
+
+
+# Give up a lease if the process holds it, so another can take over straight away
+def release_lease(name, holder):
+    db.session.execute(sa.delete(Scheduler_lease).where(Scheduler_lease.name == name, Scheduler_lease.holder == holder))
+    db.session.commit()
+
+
+# Get all the leases
+def get_leases():
+    leases = db.session.execute(db.select(Scheduler_lease).order_by(Scheduler_lease.name)).scalars().all()
+    return leases
@@ -1,58 +1,299 @@
-from models import Request, Item, Event, get_all_institutions, add_update
-from utils import database_add, delete_rows, get_report
-from datetime import datetime
+from models import (
+    Request, Item, Event, Report_row, Report_status, Report_aging, Report_partner, build_report, get_all_institutions,
+    get_institution_scalar, add_update, add_refresh_stats, prune_updates, get_current_generation, request_columns,
+    item_columns, event_columns, request_keys, item_keys, event_keys, add_schedules, get_due_schedules,
+    set_schedule, get_api_calls_since, get_latest_refresh_stats, get_schedule, claim_refresh_job,
+    set_refresh_job_progress, finish_refresh_jobs, expire_refresh_jobs
+)
+from utils import (
+    db, bulk_delete, bulk_insert, bulk_sync, bulk_copy, hash_rows, get_report_pages, decode_pages, cached_pages,
+    Prefetch, ReportCache, response_cache, exceptions_map, items_map, events_map
+)
+from settings import (
+    refresh_workers, refresh_mode, update_retention_days, report_cache_dir, replay, refresh_interval_min,
+    refresh_target, api_budget
+)
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from itertools import chain
+from flask import current_app
+from datetime import datetime, timedelta
+import threading
+import time
+import zlib
 
+# Pages buffered between the fetch, parse and load stages of each report
+pipeline_depth = 2
 
-# Update reports for all institutions
-def update_reports():
-    # Get all institutions
-    institutions = get_all_institutions()
+# Adaptive scheduling: an institution's refresh interval shrinks by interval_speedup after a refresh that changed
+#   its data and grows by interval_backoff after one that didn't, but never below interval_cost_factor times the
+#   last refresh's duration (or refresh_interval_min), nor above its freshness target
+interval_speedup = 0.5
+interval_backoff = 1.5
+interval_cost_factor = 20
+default_pages = 3  # API calls a refresh is assumed to take before it has been measured
 
-    # Loop through the institutions
-    for institution in institutions:
+# On-demand refresh jobs still running after this many seconds are assumed to have died with their process
+job_timeout = 3600
 
-        # Delete all existing requests and events for the institution
-        delete_rows(Request, institution.code)
-        delete_rows(Item, institution.code)
-        delete_rows(Event, institution.code)
+# One lock per institution, so a scheduled and an on-demand refresh of the same institution can't overlap
+institution_locks = defaultdict(threading.Lock)
+institution_locks_lock = threading.Lock()
 
-        # Requests
-        exceptions = get_report(institution.exceptions, institution.key)  # Exceptions report
 
-        # Check if there are any requests
-        if exceptions is not None:
+# Update reports for all institutions (or just the given ones), refresh_workers institutions at a time
+#   returns each institution's result from refresh_institution
+def update_reports(codes=None):
+    app = current_app._get_current_object()  # the app object to hand to the worker threads
 
-            # Loop through the rows in the exceptions report
-            for request in exceptions:
-                exinstance = institution.construct_request(request)  # Create a new request object
-                database_add(exinstance)  # Add the request to the database
-        else:
-            add_update(institution.code, datetime.now())  # Update the last updated time
-            continue
+    # Get all institution codes up front so the workers can load their own copies
+    if codes is None:
+        codes = [institution.code for institution in get_all_institutions()]
+
+    # Refresh the institutions in parallel; each worker reports its own failures
+    with ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='refresh') as executor:
+        results = dict(zip(codes, executor.map(lambda code: refresh_institution(app, code), codes)))
+
+    failed = [code for code, result in results.items() if not result['ok']]  # institutions that didn't refresh
+    if failed:
+        app.logger.error('Report refresh failed for: %s', ', '.join(failed))
+
+    prune_updates(datetime.now() - timedelta(days=update_retention_days))  # Trim the refresh history
+    return results
+
+
+# Refresh the institutions whose next refresh is due, most overdue first, as far as the hourly API call budget allows,
+#   and schedule their next refreshes; institutions that don't fit in the budget stay due until they do
+def refresh_due():
+    now = datetime.now()
+    schedule_new_institutions(now)
+    due = get_due_schedules(now)
+    if not due:
+        return {}
+
+    # Estimate each refresh's API calls from the pages its institution's latest refresh fetched
+    pages = defaultdict(int)
+    for stat in get_latest_refresh_stats():
+        pages[stat.instcode] += stat.pages
+    used = get_api_calls_since(now - timedelta(hours=1))
+    selected = []
+    for schedule in due:
+        cost = min(pages.get(schedule.instcode) or default_pages, api_budget)
+        if used + cost > api_budget:
+            break  # keep the queue's order, so a large institution isn't overtaken indefinitely by small ones
+        used += cost
+        selected.append(schedule)
+    if len(selected) < len(due):
+        current_app.logger.info('API budget reached; deferring %d due refreshes', len(due) - len(selected))
+    if not selected:
+        return {}
+
+    results = update_reports([schedule.instcode for schedule in selected])
+    for schedule in selected:
+        reschedule(schedule, results[schedule.instcode])
+    return results
+
+
+# Run the queued on-demand refresh jobs, oldest first, until the queue is empty
+#   duplicate jobs for an institution are run together; each refresh also sets the institution's next scheduled one
+def run_refresh_jobs():
+    app = current_app._get_current_object()
+    expire_refresh_jobs(datetime.now() - timedelta(seconds=job_timeout))
+    while True:
+        code = claim_refresh_job()
+        if code is None:
+            return
+
+        # Record progress without failing the refresh if it can't be written
+        def progress(step):
+            try:
+                set_refresh_job_progress(code, step)
+            except Exception:
+                app.logger.warning('Recording refresh progress failed for %s', code, exc_info=True)
+
+        result = refresh_institution(app, code, progress)
+        finish_refresh_jobs(code, result['ok'])
+        schedule = get_schedule(code)
+        if schedule is not None:
+            reschedule(schedule, result)
+
+
+# Give institutions that don't have a refresh schedule one, at a stable offset within the default interval so that
+#   they're spread out rather than all refreshed together
+def schedule_new_institutions(now):
+    schedules = []
+    for institution in get_all_institutions():
+        offset = zlib.crc32(institution.code.encode()) % refresh_target
+        schedules.append((institution.code, refresh_target, now + timedelta(seconds=offset), refresh_target))
+    add_schedules(schedules)  # only adds the ones that are missing
 
-        # Items
-        items = get_report(institution.items, institution.key)  # Items report
 
-        # Check if there are any items
-        if items is not None:
+# Set an institution's next refresh from how its last refresh went
+def reschedule(schedule, result):
+    interval = schedule.interval
+    if result['changed'] is True:
+        interval *= interval_speedup
+    elif result['changed'] is False:
+        interval *= interval_backoff  # unknown (None) leaves it as it is
+    interval = int(min(max(interval, refresh_interval_min, result['seconds'] * interval_cost_factor), schedule.target))
+    retry = interval if result['ok'] else min(interval, refresh_interval_min)  # retry failures sooner
+    set_schedule(schedule.instcode, interval, datetime.now() + timedelta(seconds=retry))
 
-            # Loop through the rows in the items report
-            for item in items:
-                itinstance = institution.construct_item(item)
-                database_add(itinstance)
+
+# Refresh a single institution in its own app context (and so its own database session)
+#   returns whether it succeeded, how long it took and whether its data changed (None if that isn't known); progress,
+#   if given, is called with each step as the refresh reaches it
+def refresh_institution(app, code, progress=None):
+    with institution_locks_lock:
+        lock = institution_locks[code]
+    with lock, app.app_context():
+        started = datetime.now()
+        start = time.perf_counter()
+        stats = {}  # report -> its timings and sizes, filled in by load_institution as it goes
+        result = {'ok': False, 'seconds': 0.0, 'changed': None}
+        try:
+            institution = get_institution_scalar(code)  # get the institution
+            generation, result['changed'] = load_institution(institution, stats, progress)  # Load and publish it
+            collect_generations(institution.code, generation)  # Then clear out the generations it replaced
+            response_cache.invalidate(institution.code)  # Pages rendered from the old data won't be asked for again
+            result['ok'] = True
+        except Exception:
+            app.logger.exception('Report refresh failed for %s', code)  # log it and let the others carry on
+        finally:
+            result['seconds'] = time.perf_counter() - start
+            record_stats(app, code, started, stats)
+    return result
+
+
+# Record an institution's refresh statistics, without letting a failure to do so fail the refresh
+def record_stats(app, code, started, stats):
+    for report, values in stats.items():
+        outcome = ' (failed)' if values['failed'] else ' (unchanged)' if values['unchanged'] else ''
+        app.logger.info(
+            'Refresh %s %s: %d pages, %d bytes, %d rows; fetch %.2fs, parse %.2fs, write %.2fs%s', code, report,
+            values['pages'], values['bytes'], values['rows'], values['fetch_seconds'], values['parse_seconds'],
+            values['write_seconds'], outcome)
+        if values['skipped']:
+            app.logger.warning('Refresh %s %s: skipped %d rows missing a required value', code, report,
+                               values['skipped'])
+    try:
+        add_refresh_stats(code, started, stats)
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('Recording refresh statistics failed for %s', code)
+
+
+# Load an institution's requests, items and events and publish them in a single transaction, returning the
+#   generation published and whether the data changed
+#   snapshot mode writes a new generation, which readers keep ignoring until the commit; incremental mode applies
+#   only the changes to the current generation, which readers likewise only see once committed
+#   stats gets the timings and sizes of each report, and of publishing the new data (as 'publish'); progress, if given,
+#   is called with each step as the refresh reaches it
+def load_institution(institution, stats, progress=None):
+    incremental = refresh_mode == 'incremental'
+    current = get_current_generation(institution.code)  # the generation readers see now
+    generation = current if incremental else current + 1  # the generation this refresh changes or writes
+    changes = {'rows': 0, 'inserted': 0, 'updated': 0, 'deleted': 0}  # totals across the three reports
+    app = current_app._get_current_object()  # the app object to hand to the pipeline threads
+    stages = []  # every pipeline stage started, to stop them if the refresh fails
+    caches = {}  # report -> its raw page cache, if report_cache_dir is set
+
+    # Start fetching and parsing one report in the background, returning its pages of row tuples
+    #   the fetch stage requests the next page while the parse stage decodes the last, and both run ahead of the
+    #   loader by at most pipeline_depth pages; with a cache, pages that match the last refresh's are held back
+    #   (see cached_pages), and replay reads the cached pages instead of calling Alma; rows missing a value for one of
+    #   obtype's NOT NULL columns are skipped (and counted) rather than failing the refresh
+    def start_report(report, path, obtype, column_map):
+        report_stats = stats[report] = defaultdict(float, failed=True)  # failed until it's loaded
+        name = f'{institution.code}-{report}'
+        fetch = get_report_pages(path, institution.key, stats=report_stats)
+        if report_cache_dir:
+            cache = caches[report] = ReportCache(institution.code, report, path, current)
+            fetch = cache.replay(report_stats) if replay else cached_pages(fetch, cache)
+        pages = Prefetch(app, fetch, pipeline_depth, name + '-fetch')
+        required = [column for column in column_map if not obtype.__table__.c[column].nullable]  # NOT NULL columns
+        rows = Prefetch(app, decode_pages(pages, column_map, required, report_stats), pipeline_depth, name + '-parse')
+        stages.extend((pages, rows))
+        return rows
+
+    # Load one report's row tuples as they arrive, returning how many rows it had
+    #   a report that's byte for byte the same as last time isn't parsed or loaded: incremental refreshes leave its
+    #   rows alone, and snapshot refreshes copy them over from the current generation
+    def load_report(report, obtype, columns, keys, stage):
+        if progress is not None:
+            progress(f'loading {report}')
+        report_stats = stats[report]
+        start = time.perf_counter()
+        columns = columns + ('rowhash',)
+        pages = iter(stage)
+        first = next(pages, None)  # None if every page was held back
+        if first is None and report in caches and caches[report].unchanged:
+            count = 0 if incremental else bulk_copy(obtype, columns, institution.code, current, generation)
+            written = {'rows': count, 'inserted': count, 'updated': 0, 'deleted': 0}
+            report_stats['unchanged'] = True
         else:
-            add_update(institution.code, datetime.now())  # Update the last updated time
-            continue
+            rows = hash_rows(row for page in chain([first or []], pages) for row in page)  # add each row's hash
+            if incremental:
+                written = bulk_sync(obtype, columns, keys, rows, institution.code, generation)
+            else:
+                count = bulk_insert(obtype, columns, rows, instcode=institution.code, generation=generation)
+                written = {'rows': count, 'inserted': count, 'updated': 0, 'deleted': 0}
+        for change in changes:
+            changes[change] += written[change]
+        report_stats['write_seconds'] = time.perf_counter() - start - stage.wait_seconds  # not counting the waits
+        report_stats['failed'] = False
+        return written['rows']
+
+    try:
+        # Request all three reports at once; items and events download while the requests are being loaded
+        exceptions = start_report('exceptions', institution.exceptions, Request, exceptions_map)
+        items = start_report('items', institution.items, Item, items_map)
+        events = start_report('events', institution.events, Event, events_map)
+
+        load_report('exceptions', Request, request_columns, request_keys, exceptions)  # Add the requests
+        load_report('items', Item, item_columns, item_keys, items)  # Add the items
+        load_report('events', Event, event_columns, event_keys, events)  # Add the events
+
+        if progress is not None:
+            progress('publishing')
+        publish = stats['publish'] = defaultdict(float, failed=True)
+        start = time.perf_counter()
+
+        # Rebuild the materialized report, unless an incremental refresh changed nothing
+        if not incremental or changes['inserted'] + changes['updated'] + changes['deleted'] > 0:
+            build_report(institution.code, generation)
+
+        add_update(institution.code, datetime.now(), generation)  # Point readers at the generation and commit
+        publish['write_seconds'] = time.perf_counter() - start
+        publish['failed'] = False
+    except Exception:
+        db.session.rollback()  # Leave the institution's current generation in place
+        for stage in stages:
+            stage.close()  # stop any downloads still running
+        for cache in caches.values():
+            cache.discard()  # and keep the cache describing the current generation
+        raise
+
+    for cache in caches.values():
+        cache.commit(generation)  # the cache now describes the published generation
 
-        # Events
-        events = get_report(institution.events, institution.key)  # Events report
+    current_app.logger.info(
+        'Refreshed %s: %d rows, %d inserted, %d updated, %d deleted', institution.code, changes['rows'],
+        changes['inserted'], changes['updated'], changes['deleted'])
 
-        # Check if there are any events
-        if events is not None:
+    # Whether the data changed: incremental refreshes count their changes, snapshot refreshes only know if every
+    #   report was cached
+    if incremental:
+        changed = changes['inserted'] + changes['updated'] + changes['deleted'] > 0
+    elif len(caches) == 3 and not replay:
+        changed = not all(stats[report]['unchanged'] for report in caches)
+    else:
+        changed = None
+    return generation, changed
 
-            # Loop through the rows in the events report
-            for event in events:
-                evinstance = institution.construct_event(event)  # Create a new event object
-                database_add(evinstance)  # Add the event to the database
 
-        add_update(institution.code, datetime.now())  # Update the last updated time
+# Delete every generation of an institution's data except the current one
+def collect_generations(instcode, generation):
+    for obtype in (Request, Item, Event, Report_row, Report_status, Report_aging, Report_partner):
+        bulk_delete(obtype, instcode, keep=generation)
+    db.session.commit()
@@ -2,3 +2,19 @@ database = ''
 shared_secret = ''
 admins = []
 log_file = ''
+refresh_workers = 4  # institutions refreshed in parallel; keep below the database pool size (default 5 + 10 overflow)
+api_timeout = (10, 300)  # Alma API (connect, read) timeouts in seconds
+api_retries = 3  # retries, with exponential backoff, for Alma API calls that fail with 429 or 5xx
+refresh_mode = 'snapshot'  # 'snapshot' reloads every row into a new generation; 'incremental' writes only changed rows
+response_cache_size = 256  # rendered report pages and downloads kept in memory per process
+scheduler_lease_ttl = 90  # seconds before another process takes over the scheduled refresh from a dead leader
+update_retention_days = 30  # days of refresh history kept in inst_update
+metrics_token = ''  # Prometheus sends it as 'Authorization: Bearer <token>'; unset, /metrics is for admins only
+report_cache_dir = ''  # if set, raw Alma report pages are cached here, and unchanged reports aren't parsed or reloaded
+replay = False  # refresh from the pages in report_cache_dir instead of calling Alma (for debugging and benchmarking)
+user_cache_ttl = 300  # seconds a user's record (admin flag, home institution) is cached for logins
+last_login_flush_seconds = 60  # how often each process writes its buffered last login times
+refresh_target = 3600  # freshness target: the longest an institution goes between refreshes, in seconds
+refresh_interval_min = 900  # the shortest an institution goes between refreshes, in seconds
+api_budget = 1000  # Alma API calls (report pages) the refreshes may make per hour, across all institutions
+refresh_cooldown = 300  # seconds before an institution's reports can be refreshed on demand again
@@ -10,49 +10,133 @@ function submitLogin() {
     return false;
 }
 
-// merge cells in report
-function mergeCells(status) {
-    let db = document.getElementById(status);
-    let dbRows = db.rows;
-    let lastValue = "";
-    let lastCounter = 1;
-    let lastRow = 0;
-
-    for (let i = 0; i < dbRows.length; i++) {
-        let thisValue = dbRows[i].cells[1].innerHTML;
-        if (thisValue === lastValue) {
-            lastCounter++;
-            dbRows[lastRow].cells[0].rowSpan = lastCounter;
-            dbRows[lastRow].cells[1].rowSpan = lastCounter;
-            dbRows[lastRow].cells[2].rowSpan = lastCounter;
-            dbRows[lastRow].cells[3].rowSpan = lastCounter;
-            dbRows[lastRow].cells[4].rowSpan = lastCounter;
-            dbRows[lastRow].cells[5].rowSpan = lastCounter;
-            dbRows[lastRow].cells[6].rowSpan = lastCounter;
-            dbRows[lastRow].cells[12].rowSpan = lastCounter;
-            dbRows[lastRow].cells[13].rowSpan = lastCounter;
-            dbRows[i].cells[0].style.display = "none";
-            dbRows[i].cells[1].style.display = "none";
-            dbRows[i].cells[2].style.display = "none";
-            dbRows[i].cells[3].style.display = "none";
-            dbRows[i].cells[4].style.display = "none";
-            dbRows[i].cells[5].style.display = "none";
-            dbRows[i].cells[6].style.display = "none";
-            dbRows[i].cells[12].style.display = "none";
-            dbRows[i].cells[13].style.display = "none";
-        } else {
-            dbRows[i].cells[0].style.display = "table-cell";
-            dbRows[i].cells[1].style.display = "table-cell";
-            dbRows[i].cells[2].style.display = "table-cell";
-            dbRows[i].cells[3].style.display = "table-cell";
-            dbRows[i].cells[4].style.display = "table-cell";
-            dbRows[i].cells[5].style.display = "table-cell";
-            dbRows[i].cells[6].style.display = "table-cell";
-            dbRows[i].cells[12].style.display = "table-cell";
-            dbRows[i].cells[13].style.display = "table-cell";
-            lastValue = thisValue;
-            lastCounter = 1;
-            lastRow = i;
+// load the next page of a report section's requests and add them to its table
+function loadRequests(details) {
+    const more = details.querySelector(".report-more");
+    const message = details.querySelector(".report-message");
+    let params = new URLSearchParams({
+        status: details.dataset.status,
+        after: details.dataset.after || 0,
+        version: details.dataset.version
+    });
+    details.dataset.after = details.dataset.after || 0;
+    more.hidden = true;
+    message.textContent = "Loading...";
+
+    fetch(details.dataset.url + "?" + params)
+        .then(function(response) {
+            return response.json().then(function(data) {
+                if (!response.ok) {
+                    throw new Error(data.error || response.statusText);
+                }
+                return data;
+            });
+        })
+        .then(function(data) {
+            const tbody = details.querySelector("tbody");
+            for (let request of data.requests) {
+                addRequestRows(tbody, request);
+            }
+            message.textContent = "";
+            if (data.next !== null) {
+                details.dataset.after = data.next;
+                more.hidden = false;
+            }
+        })
+        .catch(function(error) {
+            message.textContent = error.message;
+        });
+}
+
+// add one request's rows to a report table, merging the cells its partner rows share
+function addRequestRows(tbody, request) {
+    const rowSpan = request.partners.length;
+
+    for (let i = 0; i < request.partners.length; i++) {
+        const partner = request.partners[i];
+        let row = tbody.insertRow();
+
+        if (i === 0) {
+            addCell(row, request.borreqstat, rowSpan);
+            addCell(row, request.internalid, rowSpan);
+            addCell(row, request.borcreate, rowSpan);
+            addCell(row, request.title, rowSpan);
+            addCell(row, request.author, rowSpan);
+            addCell(row, request.networknum, rowSpan);
+            addCell(row, request.requestor, rowSpan);
+        }
+        addCell(row, partner.partnerstat, 1);
+        addCell(row, partner.reqsend ? partner.reqsend : null, 1);
+        addCell(row, partner.reqsend ? partner.days : null, 1);
+        addCell(row, partner.partnername, 1);
+        addCell(row, partner.partnercode, 1);
+        if (i === 0) {
+            addCell(row, request.eventstart ? "Y" : "N", rowSpan);
+            addCell(row, request.eventstart, rowSpan);
         }
     }
-}
\ No newline at end of file
+}
+
+// add a text cell to a table row
+function addCell(row, value, rowSpan) {
+    let cell = row.insertCell();
+    cell.textContent = value === null || value === undefined ? "" : value;
+    cell.rowSpan = rowSpan;
+}
+
+// queue an on-demand refresh of the institution's reports, then follow it until it's done and reload the page
+function requestRefresh(button, message) {
+    button.disabled = true;
+    message.textContent = "Requesting refresh...";
+
+    fetch(button.dataset.url, {method: "POST", headers: {"X-Requested-With": "fetch"}})
+        .then(readJob)
+        .then(function(job) {
+            followRefresh(job, button, message);
+        })
+        .catch(function(error) {
+            message.textContent = error.message;
+            button.disabled = false;
+        });
+}
+
+// show a refresh job's status, checking again every few seconds until it has finished
+function followRefresh(job, button, message) {
+    if (job.status === "queued") {
+        message.textContent = "Refresh queued (position " + job.position + ")";
+    } else if (job.status === "running") {
+        message.textContent = "Refreshing" + (job.progress ? ": " + job.progress : "") + " (" + job.duration + "s)";
+    } else if (job.status === "done") {
+        message.textContent = "Refreshed in " + job.duration + "s, reloading...";
+        window.location.reload();
+        return;
+    } else {
+        message.textContent = "The refresh failed.";
+        button.disabled = false;
+        return;
+    }
+
+    setTimeout(function() {
+        fetch(job.url)
+            .then(readJob)
+            .then(function(next) {
+                followRefresh(next, button, message);
+            })
+            .catch(function(error) {
+                message.textContent = error.message;
+                button.disabled = false;
+            });
+    }, 2000);
+}
+
+// read a refresh job from a response, or throw its error
+function readJob(response) {
+    return response.json().catch(function() {
+        return {};  // an error page rather than JSON
+    }).then(function(data) {
+        if (!response.ok) {
+            throw new Error(data.error || response.statusText);
+        }
+        return data;
+    });
+}
@@ -0,0 +1,28 @@
+from flask import Flask
+import importlib.util
+import sys
+import os
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+# Use the settings template's defaults when there's no settings.py, as in a fresh checkout
+if importlib.util.find_spec('settings') is None:
+    spec = importlib.util.spec_from_file_location('settings', os.path.join(root, 'settings.template.py'))
+    sys.modules['settings'] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules['settings'])
+
+
+# An app context on a fresh in-memory database, without the scheduler and logging that app.py sets up
+@pytest.fixture
+def app():
+    from utils import db
+    import models  # noqa: F401 (registers the tables)
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
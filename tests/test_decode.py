@@ -0,0 +1,42 @@
+from datetime import datetime
+from utils import decode_pages, events_map, items_map
+
+
+# One page of an analytics report, with a column header for the given columns (or none)
+def report_page(rows, header=()):
+    schema = ''.join(f'<xsd:element name="{column}"/>' for column in header)
+    body = ''.join('<Row>' + ''.join(f'<{column}>{value}</{column}>' for column, value in row.items()) + '</Row>'
+                   for row in rows)
+    return (
+        '<report><QueryResult><IsFinished>true</IsFinished><ResultXml>'
+        '<rowset xmlns="urn:schemas-microsoft-com:xml-analysis:rowset">'
+        f'<xsd:schema xmlns:xsd="http://www.w3.org/2001/XMLSchema">{schema}</xsd:schema>{body}'
+        '</rowset></ResultXml></QueryResult></report>'
+    ).encode()
+
+
+def test_columns_without_header():
+    # no column header, and the item ID column only turns up in the second row and on the second page
+    pages = [
+        report_page([{'Column0': '0', 'Column2': 'FR1'}, {'Column0': '0', 'Column1': 'IT2', 'Column2': 'FR2'}]),
+        report_page([{'Column0': '0', 'Column1': 'IT3', 'Column2': 'FR3'}]),
+    ]
+    assert list(decode_pages(pages, items_map)) == [[(None, 'FR1'), ('IT2', 'FR2')], [('IT3', 'FR3')]]
+
+
+def test_columns_from_header():
+    page = report_page([{'Column2': 'FR1', 'Column1': 'IT1'}], header=('Column0', 'Column1', 'Column2'))
+    assert list(decode_pages([page], items_map)) == [[('IT1', 'FR1')]]
+
+
+def test_rows_missing_required_values_are_skipped():
+    page = report_page([
+        {'Column0': '0', 'Column1': '2023-05-03T11:00:00', 'Column2': 'IT1'},
+        {'Column0': '0', 'Column1': 'not a date', 'Column2': 'IT2'},
+        {'Column0': '0', 'Column2': 'IT3'},
+    ], header=('Column0', 'Column1', 'Column2'))
+    stats = {'parse_seconds': 0.0, 'rows': 0, 'skipped': 0}
+    pages = list(decode_pages([page], events_map, required=('itemid', 'eventstart'), stats=stats))
+    assert pages == [[('IT1', datetime(2023, 5, 3, 11))]]
+    assert stats['rows'] == 1
+    assert stats['skipped'] == 2
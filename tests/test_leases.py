@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+from models import Scheduler_lease, acquire_lease, release_lease
+from utils import db
+import sqlalchemy as sa
+
+
+def lease():
+    db.session.expire_all()
+    return db.session.get(Scheduler_lease, 'update_reports')
+
+
+def test_renewal_keeps_acquired(app):
+    assert acquire_lease('update_reports', 'a:1', 90)
+    acquired = lease().acquired
+    assert acquire_lease('update_reports', 'a:1', 90)
+    assert lease().acquired == acquired
+
+
+def test_held_lease_is_not_taken(app):
+    assert acquire_lease('update_reports', 'a:1', 90)
+    assert not acquire_lease('update_reports', 'b:2', 90)
+    assert lease().holder == 'a:1'
+
+
+def test_takeover_resets_acquired(app):
+    past = datetime.now() - timedelta(hours=1)
+    db.session.add(Scheduler_lease('update_reports', 'a:1', past, past + timedelta(seconds=90)))  # long expired
+    db.session.commit()
+
+    assert acquire_lease('update_reports', 'b:2', 90)
+    assert lease().holder == 'b:2'
+    assert lease().acquired > past
+
+
+def test_acquired_is_assigned_before_holder(app):
+    # MySQL evaluates SET assignments left to right, so acquired must be compared with the old holder first
+    statements = []
+    sa.event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    acquire_lease('update_reports', 'a:1', 90)
+    update = next(statement for statement in statements if statement.startswith('UPDATE scheduler_lease'))
+    assignments = update.split(' SET ')[1]
+    assert assignments.index('acquired=') < assignments.index('holder=')
+
+
+def test_release_frees_the_lease(app):
+    assert acquire_lease('update_reports', 'a:1', 90)
+    release_lease('update_reports', 'a:1')
+    assert acquire_lease('update_reports', 'b:2', 90)
@@ -0,0 +1,50 @@
+from flask import Flask
+from utils import Prefetch
+import itertools
+import time
+
+
+# An endless source, slow enough that the first stage's queue is usually empty
+def slow_numbers():
+    for number in itertools.count():
+        time.sleep(0.02)
+        yield number
+
+
+def doubled(items):
+    for item in items:
+        yield item * 2
+
+
+def test_items_in_order():
+    app = Flask(__name__)
+    assert list(Prefetch(app, range(10), 2)) == list(range(10))
+
+
+def test_errors_are_raised_in_the_consumer():
+    def failing():
+        yield 1
+        raise ValueError('boom')
+
+    items = iter(Prefetch(Flask(__name__), failing(), 2))
+    assert next(items) == 1
+    try:
+        next(items)
+    except ValueError as error:
+        assert str(error) == 'boom'
+    else:
+        raise AssertionError('the error was not raised')
+
+
+def test_closing_a_pipeline_mid_stream_stops_both_stages():
+    app = Flask(__name__)
+    fetch = Prefetch(app, slow_numbers(), 2, 'test-fetch')
+    parse = Prefetch(app, doubled(fetch), 2, 'test-parse')
+    items = iter(parse)
+    assert [next(items) for _ in range(3)] == [0, 2, 4]
+
+    for stage in (fetch, parse):  # the order load_institution closes them in
+        stage.close()
+    for stage in (fetch, parse):
+        stage.thread.join(timeout=5)
+        assert not stage.thread.is_alive()
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+from models import Institution, Refresh_job, add_refresh_job, claim_refresh_job, finish_refresh_jobs, prune_updates
+from utils import db
+
+
+def test_prune_keeps_unfinished_jobs(app):
+    db.session.add_all(Institution(code, code, 'key', 'exceptions', 'items', 'events') for code in ('aa', 'bb', 'cc'))
+    db.session.commit()
+    jobs = {code: add_refresh_job(code, 'someone')[0].id for code in ('aa', 'bb', 'cc')}
+    assert claim_refresh_job() == 'aa'
+    finish_refresh_jobs('aa', True)  # aa done
+    assert claim_refresh_job() == 'bb'  # bb running, cc queued
+
+    prune_updates(datetime.now() + timedelta(days=1))  # every job is older than the cutoff
+    db.session.expire_all()
+    assert db.session.get(Refresh_job, jobs['aa']) is None
+    assert db.session.get(Refresh_job, jobs['bb']).status == 'running'
+    assert db.session.get(Refresh_job, jobs['cc']).status == 'queued'
@@ -0,0 +1,24 @@
+from datetime import datetime
+from models import Institution, Request, add_update, build_report, request_columns
+from utils import db, bulk_insert
+
+
+def request_row(internalid, status):
+    values = {column: None for column in request_columns}
+    values.update(fulfillmentreqid=f'FR{internalid}', internalid=internalid, borreqstat=status, partnercode='P1')
+    return tuple(values[column] for column in request_columns)
+
+
+def test_requests_without_a_status_can_be_paged(app):
+    institution = Institution('aa', 'AA', 'key', 'exceptions', 'items', 'events')
+    db.session.add(institution)
+    bulk_insert(Request, request_columns, [request_row('INT1', None), request_row('INT2', 'Active')], instcode='aa',
+                generation=1)
+    build_report('aa', 1)
+    add_update('aa', datetime.now(), 1)
+
+    statuses = institution.get_report_statuses(1)
+    assert [(status.borreqstat, status.requests) for status in statuses] == [('', 1), ('Active', 1)]
+    rows, after = institution.get_report_page(1, '', 0, 100)
+    assert [row.internalid for row in rows] == ['INT1']
+    assert after is None
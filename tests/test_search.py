@@ -0,0 +1,25 @@
+from datetime import datetime
+from models import Institution, add_update, fulltext_terms, get_search_version
+from utils import db
+
+
+def test_fulltext_terms_require_every_indexed_word():
+    assert fulltext_terms('Guns, Germs and Steel') == '+guns* +germs* +and* +steel*'
+
+
+def test_fulltext_terms_leave_out_stopwords_and_short_words():
+    # InnoDB doesn't index these, so requiring them would match nothing
+    assert fulltext_terms('The Art of War') == '+art* +war*'
+    assert fulltext_terms('Go Tell It on the Mountain') == '+tell* +mountain*'
+    assert fulltext_terms('of the') == ''
+
+
+def test_search_version_changes_with_a_new_generation(app):
+    db.session.add_all(Institution(code, code, 'key', 'exceptions', 'items', 'events') for code in ('aa', 'bb'))
+    add_update('aa', datetime.now(), 1)
+    add_update('bb', datetime.now(), 1)
+    everything, aa = get_search_version(None), get_search_version(['aa'])
+
+    add_update('bb', datetime.now(), 2)  # a snapshot refresh of bb
+    assert get_search_version(None) != everything
+    assert get_search_version(['aa']) == aa  # searches of aa alone can carry on
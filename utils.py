@@ -1,69 +1,635 @@
-from bs4 import BeautifulSoup
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from itertools import islice
+from collections import defaultdict, OrderedDict
+from lxml import etree
+from io import BytesIO, StringIO
+from datetime import date, datetime
+from openpyxl import Workbook
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from settings import api_timeout, api_retries, refresh_workers, response_cache_size, report_cache_dir
+import sqlalchemy as sa
 import requests
+import threading
+import queue
+import tempfile
+import shutil
+import json
+import gzip
+import os
+import hashlib
+import csv
+import time
+import re
 
 # Create a database object
 db = SQLAlchemy()
 
-# Map exceptions report columns to database columns
+
+# Bounded LRU cache of rendered responses; keys are tuples of (kind, institution code, last update, ...)
+class ResponseCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()  # shared by the request threads and the refresh workers
+
+    # Get a cached entry, marking it most recently used
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    # Cache an entry, evicting the least recently used beyond the size limit
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # Drop every entry for an institution (and the index page, which lists them all)
+    def invalidate(self, instcode):
+        with self.lock:
+            for key in [key for key in self.entries if key[1] in (instcode, None)]:
+                del self.entries[key]
+
+
+response_cache = ResponseCache(response_cache_size)
+
+
+# Bounded LRU cache whose entries expire ttl seconds after they're set
+class TTLCache:
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.lock = threading.Lock()
+
+    # Get an unexpired entry, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    # Cache an entry, evicting the least recently used beyond the size limit
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+# In-process timing histograms (e.g. request handlers, Alma API calls), rendered in the Prometheus text format
+class Metrics:
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # upper bounds in seconds
+
+    def __init__(self):
+        self.histograms = {}  # (name, labels) -> [bucket counts, count, sum, max]
+        self.lock = threading.Lock()
+
+    # Record one observation; labels is a tuple of (label, value) pairs
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            histogram = self.histograms.setdefault((name, labels), [[0] * len(self.buckets), 0, 0.0, 0.0])
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][position] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+            histogram[3] = max(histogram[3], seconds)
+
+    # Summaries as (name, labels dict, count, mean, max), in name and label order
+    def summary(self):
+        with self.lock:
+            return [(name, dict(labels), count, total / count, longest)
+                    for (name, labels), (_, count, total, longest) in sorted(self.histograms.items())]
+
+    # Prometheus exposition lines for every histogram
+    def exposition(self):
+        lines = []
+        typed = set()  # names whose TYPE line has been written
+        with self.lock:
+            for (name, labels), (counts, count, total, _) in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(prometheus_sample(name + '_bucket', labels + (('le', bound),), bucket))
+                lines.append(prometheus_sample(name + '_bucket', labels + (('le', '+Inf'),), count))
+                lines.append(prometheus_sample(name + '_count', labels, count))
+                lines.append(prometheus_sample(name + '_sum', labels, total))
+        return lines
+
+
+# One sample line in the Prometheus text format; labels is a tuple of (label, value) pairs
+def prometheus_sample(name, labels, value):
+    if labels:
+        pairs = []
+        for label, text in labels:
+            text = str(text).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')  # escape label values
+            pairs.append(f'{label}="{text}"')
+        name += '{' + ','.join(pairs) + '}'
+    return f'{name} {value}'
+
+
+metrics = Metrics()
+
+# Map exceptions report columns to database columns, with the type each is decoded as
 exceptions_map = {
-    'fulfillmentreqid': 'Column6',  # Fulfillment request ID
-    'requestorid': 'Column14',  # User primary identifier
-    'borreqstat': 'Column5',  # Borrowing request status
-    'internalid': 'Column7',  # Internal ID
-    'borcreate': 'Column4',  # Borrowing creation date
-    'title': 'Column3',  # Title
-    'author': 'Column1',  # Author
-    'networknum': 'Column2',  # Network number
-    'partnerstat': 'Column9',  # Partner status
-    'reqsend': 'Column10',  # Request sending date
-    'days': 'Column15',  # Days in status
-    'requestor': 'Column13',  # Requestor
-    'partnername': 'Column12',  # Partner name
-    'partnercode': 'Column11',  # Partner code
+    'fulfillmentreqid': ('Column6', 'text'),  # Fulfillment request ID
+    'requestorid': ('Column14', 'text'),  # User primary identifier
+    'borreqstat': ('Column5', 'text'),  # Borrowing request status
+    'internalid': ('Column7', 'text'),  # Internal ID
+    'borcreate': ('Column4', 'date'),  # Borrowing creation date
+    'title': ('Column3', 'text'),  # Title
+    'author': ('Column1', 'text'),  # Author
+    'networknum': ('Column2', 'text'),  # Network number
+    'partnerstat': ('Column9', 'text'),  # Partner status
+    'reqsend': ('Column10', 'timestamp'),  # Request sending date
+    'days': ('Column15', 'integer'),  # Days in status
+    'requestor': ('Column13', 'text'),  # Requestor
+    'partnername': ('Column12', 'text'),  # Partner name
+    'partnercode': ('Column11', 'text'),  # Partner code
+}
+
+# Map items report columns to database columns
+items_map = {
+    'itemid': ('Column1', 'text'),  # Item ID
+    'fulfillmentreqid': ('Column2', 'text'),  # Fulfillment request ID
 }
 
+# Map events report columns to database columns
+events_map = {
+    'itemid': ('Column2', 'text'),  # Item ID
+    'eventstart': ('Column1', 'timestamp'),  # Event start date
+}
+
+
+# Decode a report date (e.g. 2023-05-01), or None if it's empty or not a date
+def decode_date(value):
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+# Decode a report timestamp (e.g. 2023-05-01T10:22:33), or None if it's empty or not a timestamp
+def decode_timestamp(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Decode a report whole number (e.g. a day count, possibly sent as 12.0), or None if it's empty or not a number
+def decode_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return int(float(value))
+        except (TypeError, ValueError):
+            return None
+
+
+# Decoders for the column types used in the report maps
+decoders = {'text': lambda value: value, 'date': decode_date, 'timestamp': decode_timestamp, 'integer': decode_integer}
+
+
+# Compile a report map into a function that turns a row's values (in column position order) into a typed tuple,
+#   in the map's order; positions are resolved once, from the report's column layout
+def row_decoder(column_map, layout):
+    fields = [(layout.get(column, -1), decoders[kind]) for column, kind in column_map.values()]  # -1 is always None
+
+    def decode(values):
+        return tuple([convert(values[position]) for position, convert in fields])
+
+    return decode
+
+
+# Tag of the column definitions in a report's rowset schema
+schema_element = '{http://www.w3.org/2001/XMLSchema}element'
+
+# Alma API base URL
+api_route = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/'
+
+
+# Create the shared HTTP session for Alma API calls: pooled keep-alive connections, gzip, and bounded retry
+#   with exponential backoff on 429 and 5xx responses (honouring Retry-After)
+def api_session():
+    retry = Retry(total=api_retries, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=('GET',), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=refresh_workers * 3, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)  # one connection pool per host, sized for each refresh worker's three reports
+    session.mount('http://', adapter)
+    session.headers.update({'Accept': 'application/xml', 'Accept-Encoding': 'gzip, deflate'})
+    return session
+
+
+session = api_session()
+
 
 # Make an API call to Alma
 def api_call(params):
-    api_route = 'https://api-na.hosted.exlibrisgroup.com/almaws/v1/'
     path = api_route + params
-    response = requests.request('GET', path).content
-    return response
+    start = time.perf_counter()
+    response = session.get(path, timeout=api_timeout)  # (connect, read) timeouts so a hung call can't stall us
+    response.raise_for_status()  # don't mistake an error page for an empty report
+    content = response.content
+    elapsed = time.perf_counter() - start
 
+    logged = re.sub(r'apikey=[^&]*', 'apikey=...', params)  # keep API keys out of the logs
+    metrics.observe('alma_api_call_seconds', (), elapsed)
+    current_app.logger.info('Alma API call %s took %.3fs (%d bytes)', logged, elapsed, len(content))
+    return content
 
-# Turn the API response into a BeautifulSoup object
-def soupify(response):
-    soup = BeautifulSoup(response, features="xml")
-    return soup
 
+# Stream the rows out of one page of an analytics report as lists of values in column position order, at constant
+#   memory; each list has a spare None at the end for columns the report doesn't have
+#   layout maps ColumnN to its position, from the report's column header (on the first page) or as columns turn up
+def parse_rows(response, layout):
+    tags = ('{*}Row', schema_element)  # the only elements we need events for
+    positions = {}  # namespaced column tag -> position
 
-# Get rows from the BeautifulSoup object
-def get_rows(soup):
-    rows = soup.find_all('Row')
-    if len(rows) == 0:
-        return None
-    return rows
+    # Position of a column, by its namespaced tag
+    def position(tag):
+        if tag not in positions:
+            positions[tag] = layout.setdefault(tag.rpartition('}')[2], len(layout))
+        return positions[tag]
+
+    for _, element in etree.iterparse(BytesIO(response), events=('end',), tag=tags):
+        if element.tag == schema_element:
+            layout.setdefault(element.get('name'), len(layout))  # column header
+            continue
+        cells = [(position(column.tag), column.text or '') for column in element]
+        values = [None] * (len(layout) + 1)
+        for cell, text in cells:
+            values[cell] = text
+        yield values
+        element.clear()  # free the row's columns
+        while element.getprevious() is not None:
+            del element.getparent()[0]  # and the rows already handed out
+
+
+# Read a page's ResumptionToken and IsFinished values, which come before its rows, without parsing the rest
+def page_status(response):
+    page = {}
+    tags = ('{*}ResumptionToken', '{*}IsFinished', '{*}ResultXml')
+    for event, element in etree.iterparse(BytesIO(response), events=('start', 'end'), tag=tags):
+        name = element.tag.rpartition('}')[2]  # strip the namespace
+        if name == 'ResultXml':
+            break  # the rows start here
+        elif event == 'end' and name == 'ResumptionToken':
+            page['token'] = element.text
+        elif event == 'end' and name == 'IsFinished':
+            page['finished'] = element.text != 'false'
+    return page
+
+
+# Content hash of a report page, leaving out its ResumptionToken (which changes from one refresh to the next)
+def page_hash(response):
+    return hashlib.sha256(re.sub(rb'<ResumptionToken>[^<]*</ResumptionToken>', b'', response)).hexdigest()
+
+
+# On-disk cache of the raw pages of one institution's report, gzipped, with a manifest of their content hashes
+#   pages fetched by a refresh are staged alongside the cached ones and only replace them (commit) once the refresh
+#   has been published, so the cache always describes the published data; the previous manifest is only used if it
+#   was written for the same report path and the generation the refresh starts from
+class ReportCache:
+    def __init__(self, instcode, report, path, generation):
+        self.directory = os.path.join(report_cache_dir, instcode, report)
+        self.staging = f'{self.directory}.{os.getpid()}-{threading.get_ident()}.new'
+        shutil.rmtree(self.staging, ignore_errors=True)  # left behind by a failed refresh
+        self.path = path
+        self.hashes = []  # hashes of the pages fetched by this refresh
+        self.unchanged = False  # set once every page has turned out to match the previous refresh's
+        self.previous = self.read_manifest()
+        if self.previous is not None and (self.previous['path'] != path or self.previous['generation'] != generation):
+            self.previous = None
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, 'manifest.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    # Stage a fetched page, returning whether it's the same as the previous refresh's page in the same place
+    def add(self, response):
+        number = len(self.hashes)
+        self.hashes.append(page_hash(response))
+        os.makedirs(self.staging, exist_ok=True)
+        with open(os.path.join(self.staging, f'{number}.xml.gz'), 'wb') as file:
+            file.write(gzip.compress(response, compresslevel=1))  # fast; the XML still shrinks about tenfold
+        previous = self.previous['pages'] if self.previous is not None else []
+        return number < len(previous) and previous[number] == self.hashes[number]
+
+    # Read a page back, from the pages staged by this refresh or from the cache
+    def read(self, number, staged=True):
+        with open(os.path.join(self.staging if staged else self.directory, f'{number}.xml.gz'), 'rb') as file:
+            return gzip.decompress(file.read())
+
+    # The cached pages, for replaying a refresh without calling Alma; reading them counts as fetching in stats
+    def replay(self, stats):
+        manifest = self.read_manifest()
+        if manifest is None:
+            raise FileNotFoundError(f'No cached report in {self.directory}')
+        for number in range(len(manifest['pages'])):
+            start = time.perf_counter()
+            response = self.read(number, staged=False)
+            stats['fetch_seconds'] += time.perf_counter() - start
+            stats['pages'] += 1
+            stats['bytes'] += len(response)
+            yield response
+
+    # Replace the cached pages with the staged ones, recording the generation they were published in
+    def commit(self, generation):
+        if not os.path.isdir(self.staging):
+            return  # nothing was fetched (e.g. replaying)
+        with open(os.path.join(self.staging, 'manifest.json'), 'w') as file:
+            json.dump({'path': self.path, 'generation': generation, 'pages': self.hashes}, file)
+        retired = self.staging[:-len('.new')] + '.old'
+        if os.path.isdir(self.directory):
+            os.rename(self.directory, retired)
+        os.rename(self.staging, self.directory)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    # Throw the staged pages away
+    def discard(self):
+        shutil.rmtree(self.staging, ignore_errors=True)
+
+
+# Pass a report's pages through, staging each in the cache; pages are held back while they match the previous
+#   refresh's, and only released at the first difference, so if the whole report is unchanged nothing is passed on
+#   and cache.unchanged is set
+def cached_pages(pages, cache):
+    held = 0  # pages matching so far, held back in the staging directory
+    for response in pages:
+        if cache.add(response) and held == len(cache.hashes) - 1:
+            held += 1
+            continue
+        for number in range(held):
+            yield cache.read(number)  # the first difference: release the held pages first
+        held = 0
+        yield response
+    if cache.previous is not None and held == len(cache.previous['pages']):
+        cache.unchanged = True  # every page matched, and there were as many of them
+    else:
+        for number in range(held):
+            yield cache.read(number)
+
+
+# Iterate over an iterable in a background thread (with an app context), handing its items over through a bounded
+#   queue so the producer runs ahead of the consumer by at most maxsize items; the producer's exceptions are raised
+#   in the consumer, and close() stops the producer at its next item
+class Prefetch:
+    def __init__(self, app, iterable, maxsize, name=None):
+        self.queue = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.wait_seconds = 0.0  # time the consumer has spent waiting for items
+        self.thread = threading.Thread(target=self.produce, args=(app, iterable), name=name, daemon=True)
+        self.thread.start()
+
+    def produce(self, app, iterable):
+        with app.app_context():
+            try:
+                for item in iterable:
+                    if not self.put((True, item)):
+                        return  # closed
+            except Exception as error:
+                self.put((False, error))
+            else:
+                self.put((False, None))  # finished
+
+    # Queue an entry, unless the consumer has closed the queue first
+    def put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Hand over the items, until the producer finishes or the queue is closed (a closed producer stops without saying
+    #   so, and a consumer that's itself a Prefetch's producer must not wait for it forever)
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                more, item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    return
+                continue
+            finally:
+                self.wait_seconds += time.perf_counter() - start
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+
+    def close(self):
+        self.stopped.set()
+
+
+# Delete a table's rows for a given institution in a single set-based statement (no commit)
+#   if keep is given, rows of that generation are left alone
+def bulk_delete(obtype, instcode, keep=None):
+    statement = sa.delete(obtype).where(obtype.instcode == instcode)
+    if keep is not None:
+        statement = statement.where(obtype.generation != keep)
+    result = db.session.execute(statement)
+    return result.rowcount
+
+
+# Insert plain row tuples into a table in executemany batches (no commit)
+#   constants are extra column values shared by every row, e.g. generation
+def bulk_insert(obtype, columns, rows, batch_size=1000, **constants):
+    table = obtype.__table__  # Use the Core table so no ORM objects are created
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = [dict(zip(columns, row), **constants) for row in islice(rows, batch_size)]  # Next batch of rows
+        if not batch:
+            break
+        db.session.execute(table.insert(), batch)  # One executemany per batch
+        count += len(batch)
+    return count
+
+
+# Append a content hash of each row tuple's values, for spotting changed rows between refreshes
+def hash_rows(rows):
+    for row in rows:
+        yield row + (hashlib.blake2b(repr(row).encode(), digest_size=16).hexdigest(),)
+
+
+# Copy one generation of an institution's rows in a table to another generation in a single INSERT ... SELECT (no
+#   commit), returning the number of rows copied
+def bulk_copy(obtype, columns, instcode, source, target):
+    table = obtype.__table__
+    rows = sa.select(*[table.c[column] for column in columns], table.c.instcode, sa.literal(target)).where(
+        table.c.instcode == instcode, table.c.generation == source)
+    result = db.session.execute(table.insert().from_select(list(columns) + ['instcode', 'generation'], rows))
+    return result.rowcount
+
+
+# Bring a table's rows for one generation of an institution's data in line with incoming row tuples, issuing only
+#   the inserts, updates and deletes needed (no commit); rows are matched on the keys columns and the last column
+#   of each row must be its rowhash
+def bulk_sync(obtype, columns, keys, rows, instcode, generation, batch_size=1000):
+    table = obtype.__table__
+    keyindex = [columns.index(key) for key in keys]
+    changes = {'rows': 0, 'inserted': 0, 'updated': 0, 'deleted': 0}
+
+    # Identity and content hash of every current row
+    existing = defaultdict(list)  # key -> [(id, rowhash)]
+    current = db.session.execute(
+        sa.select(table.c.id, *[table.c[key] for key in keys], table.c.rowhash).where(
+            table.c.instcode == instcode, table.c.generation == generation))
+    for rowid, *key, rowhash in current:
+        existing[tuple(key)].append((rowid, rowhash))
+
+    # Match incoming rows against them; unchanged rows are dropped as soon as they're seen
+    changed = defaultdict(list)  # key -> [row tuple]
+    for row in rows:
+        changes['rows'] += 1
+        key = tuple(row[i] for i in keyindex)
+        matches = existing.get(key, [])
+        for position, (_, rowhash) in enumerate(matches):
+            if rowhash == row[-1]:
+                del matches[position]  # unchanged
+                break
+        else:
+            changed[key].append(row)
+
+    # Changed rows replace left-over current rows with the same key; anything else is new
+    updates, inserts = [], []
+    for key, newrows in changed.items():
+        oldrows = existing.get(key, [])
+        for row in newrows:
+            if oldrows:
+                rowid, _ = oldrows.pop()
+                updates.append(dict(zip(columns, row), b_id=rowid))
+            else:
+                inserts.append(row)
+    deletes = [rowid for oldrows in existing.values() for rowid, _ in oldrows]  # current rows no longer reported
+
+    statement = sa.update(table).where(table.c.id == sa.bindparam('b_id'))
+    for start in range(0, len(updates), batch_size):
+        db.session.execute(statement, updates[start:start + batch_size])  # executemany update by id
+    for start in range(0, len(deletes), batch_size):
+        db.session.execute(sa.delete(table).where(table.c.id.in_(deletes[start:start + batch_size])))
+    bulk_insert(obtype, columns, inserts, batch_size, instcode=instcode, generation=generation)
+
+    changes.update(inserted=len(inserts), updated=len(updates), deleted=len(deletes))
+    return changes
+
+
+# Fetch the pages of an analytics report, one at a time until Alma says it's finished
+#   if a stats dict is given, the pages, bytes and seconds spent fetching are added to it
+def get_report_pages(path, key, limit=1000, stats=None):
+    params = 'analytics/reports?limit=' + str(limit) + '&col_names=true&path=' + path + '&apikey=' + key
+    token = None  # ResumptionToken, only sent with the first page
+    if stats is None:
+        stats = defaultdict(float)
+
+    while True:
+        start = time.perf_counter()
+        response = api_call(params)
+        stats['fetch_seconds'] += time.perf_counter() - start
+        stats['pages'] += 1
+        stats['bytes'] += len(response)
+
+        page = page_status(response)
+        yield response  # Hand this page to the caller before fetching the next
+
+        if token is None:
+            token = page.get('token')
+        if token is None or page.get('finished', True):
+            break  # Single-page report or last page
+
+        params = 'analytics/reports?limit=' + str(limit) + '&token=' + token + '&apikey=' + key
+
+
+# Decode the pages of an analytics report into lists of typed tuples in column_map order, a list per page
+#   rows without a value for one of the required columns (e.g. an unparseable event date) are skipped and counted
+#   if a stats dict is given, the rows, skipped rows and seconds spent parsing and decoding are added to it
+def decode_pages(pages, column_map, required=(), stats=None):
+    layout = {}  # ColumnN -> position, shared by all the pages
+    decode, compiled = None, 0  # the decoder, and the number of columns it was compiled for
+    required = [position for position, column in enumerate(column_map) if column in required]
+    if stats is None:
+        stats = defaultdict(float)
+
+    for response in pages:
+        start = time.perf_counter()
+        rows = []
+        skipped = 0
+        for values in parse_rows(response, layout):
+            if decode is None or len(layout) != compiled:
+                decode, compiled = row_decoder(column_map, layout), len(layout)  # a column has turned up
+            row = decode(values)
+            if any(row[position] is None for position in required):
+                skipped += 1
+                continue
+            rows.append(row)
+        stats['parse_seconds'] += time.perf_counter() - start
+        stats['rows'] += len(rows)
+        stats['skipped'] += skipped
+        yield rows
 
 
-# Delete all rows from a table for a given institution
-def delete_rows(obtype, instcode):
-    objs = obtype.query.filter_by(instcode=instcode).all()
-    for obj in objs:
-        db.session.delete(obj)
-        db.session.commit()
+# Stream rows as CSV, a batch of rows per chunk
+def csv_chunks(columns, rows, batch_size=1000):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    rows = iter(rows)
+    while True:
+        writer.writerows(islice(rows, batch_size))
+        chunk = buffer.getvalue()
+        if not chunk:
+            break
+        yield chunk.encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
 
 
-# Add a row to the database
-def database_add(dbrow):
-    db.session.add(dbrow)  # Add the request to the database
-    db.session.commit()  # Commit the request to the database
+# Write rows to an XLSX file on disk with openpyxl's write-only workbook, returning the open file
+def xlsx_file(columns, rows, title):
+    workbook = Workbook(write_only=True)  # rows go straight to disk instead of into a worksheet in memory
+    worksheet = workbook.create_sheet(title)
+    worksheet.append(columns)
+    for row in rows:
+        worksheet.append(tuple(row))
+    xlsx = tempfile.TemporaryFile()
+    workbook.save(xlsx)
+    xlsx.seek(0)
+    return xlsx
 
 
-# Get all the rows from an analytics report
-def get_report(path, key):
-    params = 'analytics/reports?limit=1000&col_names=true&path=' + path + '&apikey=' + key
-    response = api_call(params)
-    soup = soupify(response)
-    rows = get_rows(soup)
-    return rows
+# Stream an open file in chunks, closing (and so deleting, for a temporary file) it at the end
+def file_chunks(fileobj, chunk_size=65536):
+    with fileobj:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk